@@ -7,6 +7,25 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = "dev"
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///site.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["TRAINING_WORKERS"] = 1
+app.config["JOB_POLL_SECONDS"] = 1
+app.config["JOB_TIMEOUT"] = 120
+app.config["MODEL_CACHE_BYTES"] = 1 << 30
+app.config["EVALUATION_CACHE_SIZE"] = 200000
+app.config["INFERENCE_BACKEND"] = "numpy"
+app.config["INFERENCE_SERVER"] = {
+    "address": "libra-inference.sock",
+    "authkey": "libra",
+    "timeout": 10.0,
+}
+app.config["MOVE_BUDGET"] = 0.15
+app.config["SESSION_CACHE_SIZE"] = 256
+app.config["SESSION_TTL"] = 30 * 60
+app.config["TENSORFLOW"] = {
+    "intra_op_threads": 0,
+    "inter_op_threads": 0,
+    "memory_growth": True,
+}
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
@@ -0,0 +1,381 @@
+"""Benchmarks for the core engine.
+
+Run with `python -m libra.core.bench <command>`, where the commands are:
+    suite: time the engine on each shape preset and board size, and print
+        the results as JSON for comparing versions;
+    backends: compare the Keras and NumPy backends, and the precisions NumPy
+        networks can be saved at,
+        exiting with status 1 if NumPy differs from Keras by more than
+        --tolerance;
+    architectures: train and compare the architecture presets;
+    checks: run regression checks which need no trained network, exiting
+        with status 1 if any fails.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from libra.core import cache
+from libra.core.game import Game
+from libra.core.main import (
+    TTT_WINNING_SHAPES,
+    WINNING_SHAPES_3LINE,
+    WINNING_SHAPES_L,
+    WINNING_SHAPES_PLUS,
+)
+from libra.core.mcts import MCTS
+from libra.core.neuralnetwork import ARCHITECTURES, NeuralNet, VERSIONS, keras
+from libra.core.numpynet import NumpyNet
+from libra.core.state import State
+from libra.core.train import RandomPlayer, generate_examples, self_play, test
+
+# Keras and NumPy differ only by float32 rounding, around 1e-6 in practice.
+PARITY_TOLERANCE = 1e-4
+
+PRESETS = {
+    "ttt": TTT_WINNING_SHAPES,
+    "l": WINNING_SHAPES_L,
+    "3line": WINNING_SHAPES_3LINE,
+    "plus": WINNING_SHAPES_PLUS,
+}
+
+
+def simulations_per_second(
+    nnet: NeuralNet, start: State, simulations: int, batch: int, moves: int
+) -> float:
+    """Time MCTS over the first few moves of a game, in simulations per second."""
+    mcts = MCTS(nnet, simulations, batch)
+    state = start
+    played = 0
+    elapsed = 0.0
+    while played < moves and state.result() is None:
+        begin = time.perf_counter()
+        pis = mcts.predict_moves(state)
+        elapsed += time.perf_counter() - begin
+        state = state.move(int(np.argmax(pis)))
+        played += 1
+    return played * simulations / elapsed
+
+
+def random_boards(size: int, count: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(-1, 2, (count, size, size)) * 1.0
+
+
+def inference_latency(nnet, boards: np.ndarray, repeats: int) -> float:
+    """Time predict_boards on a batch of boards, in seconds per call."""
+    nnet.predict_boards(boards)
+    begin = time.perf_counter()
+    for _ in range(repeats):
+        nnet.predict_boards(boards)
+    return (time.perf_counter() - begin) / repeats
+
+
+def parity(nnet: NeuralNet, exported: NumpyNet, boards: np.ndarray) -> float:
+    """The largest difference between the outputs of Keras and NumPy."""
+    pis, vs = nnet.predict_boards(boards)
+    numpy_pis, numpy_vs = exported.predict_boards(boards)
+    return max(np.abs(pis - numpy_pis).max(), np.abs(vs - numpy_vs).max())
+
+
+class SlowNet:
+    """A network giving uniform policies and even values after a delay, to
+    check behaviour which depends on inference time."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.version = next(VERSIONS)
+
+    def predict_boards(self, boards: np.ndarray):
+        time.sleep(self.delay)
+        boards = np.asarray(boards).reshape(len(boards), -1)
+        return np.full(boards.shape, 1 / boards.shape[1]), np.zeros(len(boards))
+
+    def predict_batch(self, states: List[State]):
+        return self.predict_boards(np.array([state.board for state in states]))
+
+
+def check_budget() -> List[str]:
+    """Check that a move is found when one network call outlasts the budget."""
+    failures = []
+    start = State(3, np.zeros((3, 3)), [np.array(x) for x in TTT_WINNING_SHAPES])
+    for batch in (1, 4):
+        mcts = MCTS(SlowNet(0.02), 25, batch)
+        pis = mcts.predict_moves(start, 0.5, budget=0.005)
+        if not np.all(np.isfinite(pis)) or not np.isclose(pis.sum(), 1):
+            failures.append(f"budget with batch={batch}: distribution {pis}")
+    return failures
+
+
+def checks() -> bool:
+    """Run every check, printing the failures. Returns whether all passed."""
+    failures = check_budget()
+    for failure in failures:
+        print(f"FAILED {failure}")
+    print(f"{len(failures)} checks failed." if failures else "All checks passed.")
+    return not failures
+
+
+def seed(value: int):
+    """Seed every source of randomness, and empty the shared evaluation cache
+    so that one measurement cannot warm up the next."""
+    random.seed(value)
+    np.random.seed(value)
+    cache.SHARED.clear()
+
+
+def state_throughput(start: State, games: int) -> Dict[str, float]:
+    """Time State.move and State.result over random games, then hashing."""
+    orders = [np.random.permutation(start.size**2) for _ in range(games)]
+    visited = []
+    begin = time.perf_counter()
+    for order in orders:
+        state = start
+        for cell in order:
+            if state.result() is not None:
+                break
+            state = state.move(cell)
+            visited.append(state)
+    elapsed = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    # Hashing and comparing, as a dictionary of states does.
+    {state: None for state in visited}
+    hashing = time.perf_counter() - begin
+    return {
+        "states_per_second": len(visited) / elapsed,
+        "hashes_per_second": len(visited) / hashing,
+    }
+
+
+def games_per_hour(game: Game, nnet, games: int) -> Dict[str, float]:
+    """Time self-play with generate_examples and arena matches with test()."""
+    begin = time.perf_counter()
+    for _ in range(games):
+        generate_examples(MCTS.from_args(nnet, game.args), game.start)
+    self_play_time = time.perf_counter() - begin
+
+    player1 = MCTS.from_args(nnet, game.args)
+    player2 = MCTS.from_args(nnet, game.args)
+    begin = time.perf_counter()
+    test(player1, player2, game.start, games)
+    test_time = time.perf_counter() - begin
+    return {
+        "self_play_games_per_hour": games * 3600 / self_play_time,
+        "test_games_per_hour": games * 3600 / test_time,
+    }
+
+
+def suite(args: argparse.Namespace) -> Dict:
+    """Run every measurement on every preset and size."""
+    results = []
+    for name in args.presets:
+        shapes = [np.array(x) for x in PRESETS[name]]
+        for size in args.sizes:
+            seed(args.seed)
+            keras().utils.set_random_seed(args.seed)
+            game = Game(
+                size,
+                shapes,
+                simulations=args.simulations,
+                architecture=args.architecture,
+            )
+            nnet = game.nnet
+            if args.backend == "numpy":
+                nnet = NumpyNet.from_keras(nnet)
+            result = {"preset": name, "size": size}
+
+            seed(args.seed)
+            result.update(state_throughput(game.start, args.playouts))
+
+            for batch in args.batches:
+                boards = random_boards(size, batch, args.seed)
+                latency = inference_latency(nnet, boards, args.repeats)
+                result[f"inferences_per_second_batch_{batch}"] = batch / latency
+
+            for batch in args.batches:
+                seed(args.seed)
+                result[
+                    f"simulations_per_second_batch_{batch}"
+                ] = simulations_per_second(
+                    nnet, game.start, args.simulations, batch, args.moves
+                )
+
+            seed(args.seed)
+            result.update(games_per_hour(game, nnet, args.games))
+            results.append(result)
+            print(f"Measured {name} on {size}x{size}.", file=sys.stderr)
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "settings": vars(args),
+        "results": results,
+    }
+
+
+def arena(player1, player2, start: State, matches: int) -> float:
+    """The score of player1 against player2, alternating who moves first."""
+    half = matches // 2
+    first = test(player1, player2, start, half)
+    second = test(player2, player1, start, half)
+    return (first + 1 - second) / 2
+
+
+def quantization_report(game: Game, matches: int, repeats: int):
+    """Compare each precision a NumPy network can be saved at with float32:
+    size, speed and strength."""
+    exported = NumpyNet.from_keras(game.nnet)
+    examples = self_play(game.nnet, game.start, game.args, 4)
+    boards = np.array([board for board, _, _ in examples])
+    reference_pis, reference_vs = exported.predict_boards(boards)
+    for precision in ("float32", "float16", "int8"):
+        if precision == "float32":
+            nnet = exported
+        else:
+            nnet = exported.quantize(precision, boards)
+        pis, vs = nnet.predict_boards(boards)
+        error = max(np.abs(pis - reference_pis).max(), np.abs(vs - reference_vs).max())
+        latency = inference_latency(nnet, boards[:1], repeats)
+        score = arena(
+            MCTS.from_args(nnet, game.args),
+            MCTS.from_args(exported, game.args),
+            game.start,
+            matches,
+        )
+        print(
+            f"{precision}: {nnet.stored_nbytes()} bytes saved, "
+            f"{nnet.nbytes()} in memory, {latency * 1000:.3f} ms/call, "
+            f"max difference {error:.2e}, score {score:.2f} against float32"
+        )
+
+
+def architecture_report(size: int, shapes, iters: int, matches: int, repeats: int):
+    """Train each architecture preset briefly and compare cost and strength.
+
+    Strength is the score against a random player and against the classic
+    preset, trained the same way.
+    """
+    boards = random_boards(size, 1)
+    games = {}
+    for name in ARCHITECTURES:
+        games[name] = Game(size, shapes, architecture=name, iters=iters)
+        games[name].train()
+    classic = games["classic"]
+    for name, game in games.items():
+        player = MCTS.from_args(game.nnet, game.args)
+        random_score = arena(player, RandomPlayer(), game.start, matches)
+        classic_score = arena(
+            player, MCTS.from_args(classic.nnet, classic.args), game.start, matches
+        )
+        latency = inference_latency(game.nnet, boards, repeats)
+        print(
+            f"{name}: {game.nnet.model.count_params()} parameters, "
+            f"{latency * 1000:.3f} ms/call, "
+            f"score {random_score:.2f} against random, "
+            f"{classic_score:.2f} against classic"
+        )
+
+
+def backends(args: argparse.Namespace) -> bool:
+    """Compare the backends, returning whether NumPy matches Keras within
+    args.tolerance."""
+    shapes = [np.array(x) for x in TTT_WINNING_SHAPES]
+    game = Game(args.size, shapes, simulations=args.simulations, savefile=args.savefile)
+    start, nnet = game.start, game.nnet
+    # Warm up the Keras graph for both batch shapes before timing.
+    nnet.predict(start)
+    nnet.predict_batch([start] * args.batch)
+
+    for batch in (1, args.batch):
+        rate = simulations_per_second(nnet, start, args.simulations, batch, args.moves)
+        print(f"batch={batch}: {rate:.1f} simulations/s")
+
+    exported = NumpyNet.from_keras(nnet)
+    boards = random_boards(args.size, 64)
+    difference = parity(nnet, exported, boards)
+    matched = difference <= args.tolerance
+    print(
+        f"numpy parity: max difference {difference:.2e}, "
+        f"{'within' if matched else 'FAILED, over'} tolerance {args.tolerance:.0e}"
+    )
+    for batch in (1, args.batch):
+        for name, backend in (("keras", nnet), ("numpy", exported)):
+            latency = inference_latency(backend, boards[:batch], args.repeats)
+            print(f"{name} batch={batch}: {latency * 1000:.3f} ms/call")
+
+    quantization_report(game, args.matches, args.repeats)
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_suite = commands.add_parser("suite")
+    parser_suite.add_argument(
+        "--presets", nargs="+", choices=list(PRESETS), default=list(PRESETS)
+    )
+    parser_suite.add_argument("--sizes", nargs="+", type=int, default=[3, 5, 7])
+    parser_suite.add_argument("--batches", nargs="+", type=int, default=[1, 8, 64])
+    parser_suite.add_argument("--backend", choices=["keras", "numpy"], default="keras")
+    parser_suite.add_argument("--architecture", default="classic")
+    parser_suite.add_argument("--simulations", type=int, default=50)
+    parser_suite.add_argument("--moves", type=int, default=3)
+    parser_suite.add_argument("--games", type=int, default=2)
+    parser_suite.add_argument("--playouts", type=int, default=200)
+    parser_suite.add_argument("--repeats", type=int, default=20)
+    parser_suite.add_argument("--seed", type=int, default=0)
+    parser_suite.add_argument("--output", help="a file for the JSON results")
+
+    parser_backends = commands.add_parser("backends")
+    parser_backends.add_argument("--size", type=int, default=3)
+    parser_backends.add_argument("--simulations", type=int, default=200)
+    parser_backends.add_argument("--batch", type=int, default=8)
+    parser_backends.add_argument("--moves", type=int, default=3)
+    parser_backends.add_argument("--repeats", type=int, default=50)
+    parser_backends.add_argument("--matches", type=int, default=16)
+    parser_backends.add_argument("--savefile", help="a trained Keras model")
+    parser_backends.add_argument(
+        "--tolerance",
+        type=float,
+        default=PARITY_TOLERANCE,
+        help="the largest difference allowed between Keras and NumPy outputs",
+    )
+
+    parser_architectures = commands.add_parser("architectures")
+    parser_architectures.add_argument("iters", type=int)
+    parser_architectures.add_argument("--size", type=int, default=3)
+    parser_architectures.add_argument("--repeats", type=int, default=50)
+    parser_architectures.add_argument("--matches", type=int, default=16)
+
+    commands.add_parser("checks")
+
+    args = parser.parse_args()
+    if args.command == "suite":
+        report = json.dumps(suite(args), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(report + "\n")
+        else:
+            print(report)
+    elif args.command == "backends":
+        sys.exit(0 if backends(args) else 1)
+    elif args.command == "checks":
+        sys.exit(0 if checks() else 1)
+    else:
+        shapes = [np.array(x) for x in TTT_WINNING_SHAPES]
+        architecture_report(args.size, shapes, args.iters, args.matches, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
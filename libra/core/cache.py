@@ -0,0 +1,101 @@
+"""A cache of neural network evaluations shared between searches.
+
+Classes:
+    EvaluationCache
+"""
+
+from collections import OrderedDict
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+from libra.core.neuralnetwork import NeuralNet
+from libra.core.state import State
+from libra.core import symmetry, utils
+
+
+class EvaluationCache:
+    """A bounded LRU cache of network evaluations.
+
+    Positions are stored in a canonical orientation, chosen among the
+    rotations and reflections which leave their game unchanged, so that
+    symmetric copies of a position share one entry. Entries are keyed by the
+    version of the network which made them, so a cache can be shared between
+    several networks and never returns stale evaluations after training.
+    An entry holds a policy over every cell, so at 9x9 the default capacity
+    takes on the order of 100 MB.
+
+    Attributes:
+        capacity: the most entries kept before the least recent are dropped;
+        hits: the number of evaluations answered from the cache;
+        misses: the number of evaluations passed to the network.
+    """
+
+    def __init__(self, capacity: int = 200000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def evaluate(
+        self, nnet: NeuralNet, states: List[State]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Evaluate states with nnet, calling it only for unseen positions.
+
+        Several threads may evaluate at once. The lock is held while entries
+        are read, added and evicted, but not during the network call.
+        """
+        keys = []
+        transforms = []
+        for state in states:
+            t, key = symmetry.canonical(state.board, state.rules.symmetries)
+            keys.append((nnet.version, state.size, key))
+            transforms.append(t)
+
+        # The evaluations needed, by key, copied out of the cache so that
+        # evictions by other threads cannot lose them.
+        found = {}
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in found or key in missing:
+                    continue
+                entry = self.entries.get(key)
+                if entry is None:
+                    missing[key] = i
+                else:
+                    self.entries.move_to_end(key)
+                    found[key] = entry
+            self.hits += len(states) - len(missing)
+            self.misses += len(missing)
+        utils.count("cache_hits", len(states) - len(missing))
+        utils.count("cache_misses", len(missing))
+
+        if missing:
+            policies, values = nnet.predict_batch([states[i] for i in missing.values()])
+            for (key, i), policy, value in zip(missing.items(), policies, values):
+                size = states[i].size
+                policy = policy[symmetry.permutation(size, transforms[i])]
+                found[key] = (policy, value)
+            with self.lock:
+                for key in missing:
+                    self.entries[key] = found[key]
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+
+        policies = []
+        values = []
+        for state, key, t in zip(states, keys, transforms):
+            policy, value = found[key]
+            policies.append(symmetry.untransform_policy(policy, state.size, t))
+            values.append(value)
+        return np.array(policies), np.array(values)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+SHARED = EvaluationCache()
@@ -4,15 +4,15 @@ Classes:
     Game
 """
 
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 
 import numpy as np
-from tensorflow import keras
-
 from libra.core.mcts import MCTS
-from libra.core.neuralnetwork import NeuralNet
+from libra.core.neuralnetwork import NeuralNet, OrientedNet
+from libra.core.numpynet import NumpyNet
 from libra.core.state import State
-from libra.core.train import train
+from libra.core import registry
+from libra.core.train import self_play, train
 from libra.core import utils
 
 
@@ -38,7 +38,8 @@ class Game:
         """Constructor for the game class.
 
         This sets up the configuration options and loads a pretrained newtork if
-        specified.
+        specified. Loaded networks come from registry.py and may be shared with
+        other games.
 
         Args:
             size: the size of the game board;
@@ -46,19 +47,56 @@ class Game:
             kwargs: available keyword arguments are:
                 iters: the number of iterations of self-play;
                 episodes: the number of games to use in each iteration;
+                replay_capacity: the most self-play examples kept for training;
+                replay_half_life: if set, training favours examples fewer than
+                    about this many examples old (see replay.py);
+                lockstep: the number of self-play games played side by side;
                 simulations: the number of searches to use in MCTS;
+                budget: if set, the seconds predict searches for instead of
+                    running simulations searches;
+                batch: the number of leaves MCTS evaluates per network call;
+                validate: whether MCTS checks its statistics for invalid values;
+                max_nodes: the most nodes MCTS keeps in its tree, if limited;
+                max_bytes: the most memory MCTS uses for its tree, if limited;
+                cache: whether MCTS shares network evaluations through cache.py;
                 matches: the number of matches to play against previous iterations;
                 threshold: the minimum win rate needed to accept the new model;
-                savefile: the name of the file to load a model from, if any.
+                workers: the number of processes used for self-play and matches;
+                savefile: the name of the file to load a model from, if any;
+                checkpoint: a directory to keep self-play examples and save
+                    the network in after every iteration, if any;
+                backend: "keras", or "numpy" to play a loaded model without
+                    TensorFlow (see numpynet.py and registry.py), or "remote"
+                    to have the inference server evaluate it (see server.py);
+                    only keras can be trained;
+                architecture: the shape of a new network, a preset name from
+                    neuralnetwork.ARCHITECTURES or a dict overriding parts
+                    of the classic preset;
+                orientation: the transform (see symmetry.py) taking boards of
+                    this game to the game the loaded model was trained on.
                 See the code for default values of these arguments.
         """
         self.args = {
             "iters": 10,
             "episodes": 16,
+            "replay_capacity": 50000,
+            "replay_half_life": None,
+            "lockstep": 1,
             "simulations": 25,
+            "budget": None,
+            "batch": 1,
+            "validate": False,
+            "max_nodes": 20000,
+            "max_bytes": None,
+            "cache": True,
             "matches": 16,
             "threshold": 0.55,
+            "workers": 1,
             "savefile": None,
+            "checkpoint": None,
+            "backend": "keras",
+            "architecture": "classic",
+            "orientation": 0,
         }
         self.args.update(kwargs)
         self.size = size
@@ -66,23 +104,61 @@ class Game:
         self.current_player = 1
         self.start = State(size, np.zeros((size, size)), winning_shapes)
         self.state = self.start
-        self.nnet = NeuralNet(size)
         if self.args["savefile"]:
-            self.nnet.model = keras.models.load_model(self.args["savefile"])
-        self.mcts = MCTS(self.nnet, self.args["simulations"])
-
-    def train(self):
-        """Train the model through self-play."""
-        self.mcts = MCTS(train(self.nnet, self.start, self.args), self.mcts.simulations)
+            self.nnet = registry.load(self.args["savefile"], self.args["backend"])
+        else:
+            self.nnet = NeuralNet(size, self.args["architecture"])
+        if self.args["orientation"]:
+            self.nnet = OrientedNet(self.nnet, self.args["orientation"])
+        self.mcts = MCTS.from_args(self.nnet, self.args)
+
+    def train(
+        self,
+        progress: Optional[Callable[[int, int], None]] = None,
+        resume: bool = False,
+    ):
+        """Train the model through self-play.
+
+        If given, progress is called with the number of iterations done and the
+        total after each iteration. With resume set, training continues from
+        the last checkpoint in the checkpoint directory instead of this game's
+        network, until iters iterations are done in all.
+        """
+        if self.args["backend"] != "keras":
+            raise ValueError("Only Keras networks can be trained.")
+        self.nnet = train(self.nnet, self.start, self.args, progress, resume)
+        self.mcts = MCTS.from_args(self.nnet, self.args)
 
     def reset(self):
         """Reset the game back to its initial state."""
         self.current_player = 1
         self.state = self.start
+        self.mcts.reroot(self.state)
 
-    def predict(self, temperature: float = 0.5) -> int:
-        """Use the model to calculate the best move."""
-        pis = self.mcts.predict_moves(self.state, temperature)
+    def set_position(self, board: np.ndarray, current_player: int):
+        """Continue from a board given as by current_board."""
+        self.current_player = current_player
+        self.state = State(self.size, board * current_player, self.winning_shapes)
+        self.mcts.reroot(self.state)
+
+    def predict(self, temperature: float = 0.5, budget: Optional[float] = None) -> int:
+        """Use the model to calculate the best move.
+
+        Args:
+            temperature: how far to favour the most searched moves, 0 always
+                choosing one of them;
+            budget: if given, search for at most this many seconds instead
+                of a fixed number of simulations, see MCTS.search_for. The
+                number of simulations run is left in self.mcts.searched.
+
+        Returns:
+            The index of the chosen move.
+        """
+        if budget is None:
+            budget = self.args["budget"]
+        with utils.timer("game_predict_seconds"):
+            pis = self.mcts.predict_moves(self.state, temperature, budget)
+        utils.debug("Searched %d simulations.", self.mcts.searched)
         return np.random.choice(range(len(pis)), p=pis)
 
     def can_move(self, index: int) -> bool:
@@ -93,18 +169,39 @@ class Game:
         """Perform a move at index, if valid."""
         if not self.can_move(index):
             utils.warn("Attempted invalid move.")
-            utils.debug(
-                f"In {self.state.__str__(self.current_player)} at index {index}"
-            )
+            utils.debug("In %s at index %s", self, index)
             return False
         self.state = self.state.move(index)
         self.current_player *= -1
+        self.mcts.reroot(self.state)
         return True
 
+    def memory(self) -> Dict[str, int]:
+        """Report the memory used by the search tree."""
+        return self.mcts.memory()
+
     def save_model(self, filename: str):
         """Save the neural network to filename"""
         self.nnet.save(filename)
 
+    def export_model(
+        self, filename: str, precision: str = "float32", calibration: int = 4
+    ):
+        """Save the neural network for the NumPy backend to filename.
+
+        A "float16" or "int8" file is smaller, but loads as a float32 network
+        and plays no faster (see NumpyNet.quantize). int8 is calibrated on
+        positions from the given number of self-play games.
+        """
+        exported = NumpyNet.from_keras(self.nnet)
+        if precision == "int8":
+            examples = self_play(self.nnet, self.start, self.args, calibration)
+            boards = np.array([board for board, _, _ in examples])
+            exported = exported.quantize(precision, boards)
+        elif precision != "float32":
+            exported = exported.quantize(precision)
+        exported.save(filename)
+
     def evaluation(self) -> float:
         """Find the evaluation of the current state."""
         return self.nnet.predict(self.state)[-1] * self.current_player
@@ -1,34 +1,181 @@
 import random
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 
+from libra.core import cache
+from libra.core.cache import EvaluationCache
 from libra.core.neuralnetwork import NeuralNet
 from libra.core.state import State
 from libra.core import utils
 
+Path = List[Tuple[int, int]]
+
+
+def puct(
+    values: np.ndarray,
+    visits: np.ndarray,
+    priors: np.ndarray,
+    total: int,
+    pending: np.ndarray,
+) -> np.ndarray:
+    """Compute the upper confidence bounds of all the moves from a node.
+
+    Moves with pending searches are scored as though each of them was lost.
+    """
+    if pending.any():
+        values = (values * visits - pending) / np.maximum(visits + pending, 1)
+        visits = visits + pending
+    return values + priors * np.sqrt(2 * total / (1 + visits))
+
 
 class MCTS:
-    def __init__(self, nnet: NeuralNet, simulations: int):
+    """Monte-Carlo tree search guided by a neural network.
+
+    Each state met during search is given an index into a node table, and the
+    statistics of its moves are stored as rows of preallocated arrays, which
+    grow as needed:
+        visits: the number of times each move was searched;
+        values: the mean value of each move, for the player to move;
+        priors: the network's policy over the legal moves;
+        legal: which moves are legal;
+        children: the index of the node each move leads to, or -1 if unknown;
+        pending: the virtual loss on each move from unfinished searches;
+        totals: the number of searches through the node;
+        outcome: the result of the node's state, or NaN if the game goes on;
+        expanded: whether the node has been evaluated by the network;
+        stamps: the simulation which last passed through the node.
+    If cache is given, network evaluations are looked up and stored there.
+    If max_nodes or max_bytes is set, the least recently visited nodes are
+    evicted whenever the tree outgrows them.
+    If validate is set, each selection also rules out moves with NaN or
+    negative statistics, with a warning; this is meant for debugging.
+    """
+
+    # The type, whether there is one entry per move, and the initial value of
+    # each array in the node table.
+    FIELDS = {
+        "visits": (np.int32, True, 0),
+        "values": (np.float32, True, 0),
+        "priors": (np.float32, True, 0),
+        "legal": (bool, True, False),
+        "children": (np.int32, True, -1),
+        "pending": (np.int32, True, 0),
+        "totals": (np.int64, False, 0),
+        "outcome": (np.float64, False, np.nan),
+        "expanded": (bool, False, False),
+        "stamps": (np.int64, False, 0),
+    }
+
+    # The fraction of the node budget left after an eviction, so that evictions
+    # do not happen on every search once the tree is full.
+    RETAIN = 0.75
+
+    def __init__(
+        self,
+        nnet: NeuralNet,
+        simulations: int,
+        batch: int = 1,
+        validate: bool = False,
+        max_nodes: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        cache: Optional[EvaluationCache] = None,
+    ):
         self.nnet = nnet
-        self.move_visits = {}
-        self.state_visits = {}
-        self.valuation = {}
-        self.policy = {}
-        self.moves = {}
-        self.result = {}
         self.simulations = simulations
+        self.batch = batch
+        self.validate = validate
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.clock = 0
+        self.searched = 0
+        self.clear()
 
-    def predict_moves(self, state: State, temp: float = 1) -> np.ndarray:
-        for _ in range(self.simulations):
-            self.search(state)
-
-        counts = np.array(
-            [
-                float(self.move_visits.get((state, a), 0))
-                for a in range(len(self.moves[state]))
-            ]
+    @classmethod
+    def from_args(cls, nnet: NeuralNet, args: Dict) -> "MCTS":
+        """Create a search configured by the arguments of a Game."""
+        return cls(
+            nnet,
+            args["simulations"],
+            args["batch"],
+            args["validate"],
+            args["max_nodes"],
+            args["max_bytes"],
+            cache.SHARED if args["cache"] else None,
         )
 
+    def predict_moves(
+        self, state: State, temp: float = 1, budget: Optional[float] = None
+    ) -> np.ndarray:
+        """Search from state and turn the visits of its moves into probabilities.
+
+        Runs self.simulations simulations, or if budget is given, as many as
+        fit in that many seconds (see search_for). The number run is left in
+        self.searched.
+        """
+        if budget is not None:
+            self.searched = self.search_for(state, budget)
+        elif self.batch > 1:
+            done = 0
+            while done < self.simulations:
+                done += self.search_batch(
+                    state, min(self.batch, self.simulations - done)
+                )
+            self.searched = done
+        else:
+            for _ in range(self.simulations):
+                self.search(state)
+            self.searched = self.simulations
+
+        utils.observe("mcts_simulations_per_move", self.searched)
+        return self.distribution(state, temp)
+
+    def search_for(self, state: State, budget: float) -> int:
+        """Search from state until budget seconds have passed.
+
+        Stops early once the most visited move leads the next by more visits
+        than the simulations expected in the time left, at the rate so far,
+        since it would then be chosen at temperature 0 whatever they found.
+        Searching goes on past the budget until some move from state has been
+        visited, so that there is a distribution to return. Returns the number
+        of simulations run.
+        """
+        start = time.perf_counter()
+        done = 0
+        while True:
+            if self.batch > 1:
+                done += self.search_batch(state, self.batch)
+            else:
+                self.search(state)
+                done += 1
+
+            root = self.node(state)
+            counts = self.visits[root][self.legal[root]]
+            if not counts.any() and np.isnan(self.outcome[root]):
+                # Only the root has been evaluated so far.
+                continue
+            elapsed = time.perf_counter() - start
+            if elapsed >= budget or len(counts) < 2:
+                return done
+            second, first = np.partition(counts, -2)[-2:]
+            if first - second > done / elapsed * (budget - elapsed):
+                return done
+
+    def distribution(self, state: State, temp: float = 1) -> np.ndarray:
+        """Turn the visit counts of the moves from state into probabilities.
+
+        If no move has been visited yet, the network's policy is used instead.
+        """
+        root = self.nodes[state]
+        counts = self.visits[root].astype(float)
+        if not counts.any():
+            counts = self.priors[root].astype(float)
+        utils.observe("mcts_tree_nodes", len(self.states))
+        utils.observe("mcts_tree_bytes", self.memory()["bytes"], utils.BYTE_BUCKETS)
+
         if temp == 0:
             best = np.array(np.argwhere(counts == np.max(counts))).flatten()
             best = best[random.randrange(len(best))]
@@ -41,67 +188,288 @@ class MCTS:
         return counts
 
     def search(self, state: State) -> float:
-        if state not in self.result:
-            self.result[state] = state.result()
-
-        if self.result[state] is not None:
-            return self.result[state]
-
-        if state not in self.policy:
-            self.policy[state], value = self.nnet.predict(state)
-            self.moves[state] = state.moves()
-            self.policy[state] = self.policy[state] * self.moves[state]
-            if np.sum(self.policy[state]) != 0:
-                self.policy[state] /= np.sum(self.policy[state])
-            self.state_visits[state] = 0
-            return value
-
-        def evaluation(move):
-            if self.moves[state][move] == 0:
-                return -np.Infinity
-
-            val = self.valuation.get((state, move), 0)
-            vis = self.move_visits.get((state, move), 0)
-            tot = self.state_visits[state]
-            policy = self.policy[state][move]
-
-            if (
-                tot < 0
-                or (1 + vis) <= 0
-                or np.isnan(val)
-                or np.isnan(vis)
-                or np.isnan(tot)
-                or np.isnan(policy)
-            ):
-                utils.warn(f"Received invalid information for state {str(state)}.")
-                utils.debug(
-                    f"val = {val}, vis = {vis}, tot = {tot}, policy = {policy}."
-                )
-                return -np.Infinity
+        utils.count("mcts_simulations")
+        self.trim()
+        path, leaf = self.descend(self.node(state))
+        if np.isnan(self.outcome[leaf]):
+            policies, values = self.evaluate([self.states[leaf]])
+            value = values[0]
+            self.expand(leaf, policies[0])
+        else:
+            value = self.outcome[leaf]
+        return self.backup(path, value)
 
-            return val + policy * (2 * tot / (1 + vis)) ** 0.5
+    def search_batch(self, state: State, count: int) -> int:
+        """Run count simulations, evaluating all new leaves in one network call.
 
-        best_move = max(range(len(self.moves[state])), key=evaluation)
+        Returns the number of simulations performed.
+        """
+        leaves = self.gather(state, count)
+        if leaves:
+            policies, values = self.evaluate(list(leaves))
+            self.resolve(leaves, policies, values)
+        return count
 
-        if evaluation(best_move) == -np.Infinity:
-            utils.warn(
-                f"No valid moves found for {state} (state.moves is {state.moves()}), choosing {best_move}."
-            )
-            utils.debug(
-                f"Evaluations are {list(map(evaluation, range(len(state.moves()))))}."
-            )
+    def evaluate(self, states: List[State]) -> Tuple[np.ndarray, np.ndarray]:
+        """Evaluate states with the network, through the cache if there is one."""
+        if self.cache is None:
+            return self.nnet.predict_batch(states)
+        return self.cache.evaluate(self.nnet, states)
+
+    def gather(self, state: State, count: int) -> Dict[State, List[Path]]:
+        """Descend count times from state and collect the leaves to evaluate.
+
+        Each descent adds a virtual loss to the moves it takes, so that later
+        descents are steered towards other branches. Descents which end on a
+        leaf that is already pending share its evaluation, and descents which
+        end on a finished game are backed up immediately.
+        """
+        utils.count("mcts_simulations", count)
+        self.trim()
+        root = self.node(state)
+        leaves = {}
+        for _ in range(count):
+            path, leaf = self.descend(root)
+            if np.isnan(self.outcome[leaf]):
+                leaves.setdefault(self.states[leaf], []).append(path)
+            else:
+                self.backup(path, self.outcome[leaf])
+        return leaves
 
-        value = -self.search(state.move(best_move))
+    def resolve(
+        self,
+        leaves: Dict[State, List[Path]],
+        policies: np.ndarray,
+        values: np.ndarray,
+    ):
+        """Expand the leaves from gather with their network evaluations."""
+        for leaf, policy, value in zip(leaves, policies, values):
+            self.expand(self.nodes[leaf], policy)
+            for path in leaves[leaf]:
+                self.backup(path, value)
 
-        self.state_visits[state] += 1
-        key = (state, best_move)
-        if (state, best_move) in self.move_visits:
-            self.valuation[key] *= self.move_visits[key]
-            self.valuation[key] += value
-            self.move_visits[key] += 1
-            self.valuation[key] /= self.move_visits[key]
+    def node(self, state: State) -> int:
+        """Find the index of state in the node table, adding it if needed."""
+        index = self.nodes.get(state)
+        if index is None:
+            index = len(self.states)
+            if index == self.capacity:
+                self.grow(state.size * state.size)
+            self.nodes[state] = index
+            self.states.append(state)
+            res = state.result()
+            self.outcome[index] = np.nan if res is None else res
+        return index
+
+    def reroot(self, state: State):
+        """Make state the root of the tree, dropping nodes it cannot reach.
+
+        The statistics below state are kept, so later searches from it carry on
+        where earlier ones left off.
+        """
+        root = self.nodes.get(state)
+        if root is None:
+            self.clear()
         else:
-            self.valuation[key] = value
-            self.move_visits[key] = 1
+            self.compact(self.reachable(root))
+
+    def trim(self):
+        """Evict the least recently visited nodes if the tree is over budget.
 
+        Searches touch every node on their path, so a node is never more
+        recent than its parent and whole subtrees are evicted from the bottom.
+        """
+        limit = self.limit()
+        # Leave room for the nodes the coming search may add.
+        if limit is None or len(self.states) + self.batch <= limit:
+            return
+        keep = max(1, min(int(limit * MCTS.RETAIN), limit - self.batch))
+        order = np.argsort(self.stamps[: len(self.states)], kind="stable")
+        utils.debug(
+            "Evicting %d of %d nodes.", len(self.states) - keep, len(self.states)
+        )
+        self.compact(np.sort(order[-keep:]))
+
+    def limit(self, actions: Optional[int] = None) -> Optional[int]:
+        """The largest number of nodes allowed by the budget, if any.
+
+        The byte budget covers every row allocated in the node table, used or
+        not, so the table is never grown past this many rows.
+        """
+        limits = []
+        if self.max_nodes is not None:
+            limits.append(self.max_nodes)
+        if self.max_bytes is not None:
+            limits.append(max(1, self.max_bytes // self.node_bytes(actions)))
+        return min(limits) if limits else None
+
+    def node_bytes(self, actions: Optional[int] = None) -> int:
+        """Estimate the memory used by each row of the node table and its state,
+        for nodes with the given number of moves, by default that of the table."""
+        if actions is None:
+            actions = self.visits.shape[1]
+        row = sum(
+            np.dtype(dtype).itemsize * (actions if per_move else 1)
+            for dtype, per_move, _ in MCTS.FIELDS.values()
+        )
+        return row + self.state_bytes()
+
+    def state_bytes(self) -> int:
+        """Estimate the memory used by each state and its lookup entries."""
+        if not self.states:
+            return 0
+        state = self.states[0]
+        masks = (state.own, state.opp, state.key, state.flip)
+        # Roughly one dict entry and one list slot per state.
+        return sys.getsizeof(state) + sum(map(sys.getsizeof, masks)) + 64
+
+    def memory(self) -> Dict[str, int]:
+        """Report the size of the tree, for monitoring."""
+        arrays = sum(getattr(self, name).nbytes for name in MCTS.FIELDS)
+        return {
+            "nodes": len(self.states),
+            "capacity": self.capacity,
+            "bytes": arrays + len(self.states) * self.state_bytes(),
+        }
+
+    def clear(self):
+        self.nodes = {}
+        self.states = []
+        self.capacity = 0
+        for name, (dtype, per_move, _) in MCTS.FIELDS.items():
+            setattr(self, name, np.zeros((0, 0) if per_move else 0, dtype=dtype))
+
+    def reachable(self, root: int) -> np.ndarray:
+        """Find the indices of the nodes which can be reached from root."""
+        seen = np.zeros(len(self.states), dtype=bool)
+        seen[root] = True
+        frontier = np.array([root])
+        while len(frontier):
+            children = self.children[frontier].flatten()
+            children = np.unique(children[children >= 0])
+            frontier = children[~seen[children]]
+            seen[frontier] = True
+        return np.flatnonzero(seen)
+
+    def compact(self, keep: np.ndarray):
+        """Drop every node not in keep, renumbering the rest in order."""
+        count = len(self.states)
+        remap = np.full(count + 1, -1, dtype=np.int32)
+        remap[keep] = np.arange(len(keep))
+
+        for name, (_, _, fill) in MCTS.FIELDS.items():
+            array = getattr(self, name)
+            array[: len(keep)] = array[keep]
+            array[len(keep) : count] = fill
+        # Unknown children stay -1, as remap[-1] is -1.
+        self.children[: len(keep)] = remap[self.children[: len(keep)]]
+
+        self.states = [self.states[i] for i in keep]
+        self.nodes = {state: i for i, state in enumerate(self.states)}
+
+        limit = self.limit()
+        if limit is not None and self.capacity > max(limit, len(keep)):
+            self.resize(max(limit, len(keep)), self.visits.shape[1])
+
+    def grow(self, actions: int):
+        """Double the capacity of the node table, within the budget if any."""
+        capacity = max(64, 2 * self.capacity)
+        limit = self.limit(actions)
+        if limit is not None:
+            capacity = min(capacity, max(limit, self.capacity + 1))
+        self.resize(capacity, actions)
+
+    def resize(self, capacity: int, actions: int):
+        """Reallocate the node table with room for capacity nodes."""
+        kept = min(self.capacity, capacity)
+        for name, (dtype, per_move, fill) in MCTS.FIELDS.items():
+            shape = (capacity, actions) if per_move else capacity
+            array = np.full(shape, fill, dtype=dtype)
+            if kept:
+                array[:kept] = getattr(self, name)[:kept]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def descend(self, node: int) -> Tuple[Path, int]:
+        """Follow the best moves from node to a finished or unexpanded node."""
+        self.clock += 1
+        path = []
+        self.stamps[node] = self.clock
+        while self.expanded[node] and np.isnan(self.outcome[node]):
+            move = self.select(node)
+            self.pending[node, move] += 1
+            path.append((node, move))
+            child = self.children[node, move]
+            if child < 0:
+                child = self.node(self.states[node].move(move))
+                self.children[node, move] = child
+            node = child
+            self.stamps[node] = self.clock
+        return path, node
+
+    def backup(self, path: Path, value: float) -> float:
+        """Propagate the value of the last node in path back to the root."""
+        for node, move in reversed(path):
+            value = -value
+            self.pending[node, move] -= 1
+            self.update(node, move, value)
         return value
+
+    def expand(self, node: int, policy: np.ndarray):
+        legal = self.states[node].moves().astype(bool)
+        policy = policy * legal
+        if np.sum(policy) != 0:
+            policy /= np.sum(policy)
+        self.priors[node] = policy
+        self.legal[node] = legal
+        self.expanded[node] = True
+
+    def select(self, node: int) -> int:
+        """Pick the move from node with the highest upper confidence bound."""
+        scores = puct(
+            self.values[node],
+            self.visits[node],
+            self.priors[node],
+            self.totals[node],
+            self.pending[node],
+        )
+        if self.validate:
+            self.check(node, scores)
+        scores[~self.legal[node]] = -np.inf
+
+        best_move = int(np.argmax(scores))
+        if scores[best_move] == -np.inf:
+            utils.warn(
+                "No valid moves found for %s (state.moves is %s), choosing %d.",
+                self.states[node],
+                self.legal[node].astype(int),
+                best_move,
+            )
+            utils.debug("Evaluations are %s.", scores)
+
+        return best_move
+
+    def check(self, node: int, scores: np.ndarray):
+        """Rule out moves from node whose statistics are invalid."""
+        invalid = np.isnan(scores) | (self.visits[node] < 0)
+        if self.totals[node] < 0:
+            invalid[:] = True
+        invalid &= self.legal[node]
+        if invalid.any():
+            utils.warn("Received invalid information for state %s.", self.states[node])
+            utils.debug(
+                "values = %s, visits = %s, total = %s, priors = %s.",
+                self.values[node],
+                self.visits[node],
+                self.totals[node],
+                self.priors[node],
+            )
+            scores[invalid] = -np.inf
+
+    def update(self, node: int, move: int, value: float):
+        visits = self.visits[node, move]
+        self.values[node, move] = (self.values[node, move] * visits + value) / (
+            visits + 1
+        )
+        self.visits[node, move] = visits + 1
+        self.totals[node] += 1
@@ -1,67 +1,222 @@
-from typing import List, Tuple
+import itertools
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
-from tensorflow.keras.layers import *
-from tensorflow.keras.models import *
-from tensorflow.keras.optimizers import *
-from tensorflow.compat.v1 import ConfigProto
-from tensorflow.compat.v1 import InteractiveSession
 
+from libra.core.replay import ReplayBuffer
 from libra.core.state import State
+from libra.core import symmetry, utils
 
-config = ConfigProto()
-config.gpu_options.allow_growth = True
-session = InteractiveSession(config=config)
+# TensorFlow is imported on first use by keras(), with these settings. Thread
+# counts of 0 let TensorFlow choose.
+SETTINGS = {"intra_op_threads": 0, "inter_op_threads": 0, "memory_growth": True}
+_TENSORFLOW = None
+
+# Every set of weights gets a new version number, so that evaluations made by
+# different or retrained networks are never confused.
+VERSIONS = itertools.count()
+
+
+# Network shapes to choose from by name. width is the number of channels of
+# each convolution, and kernel their size, 0 meaning the board size. convs
+# convolutions are followed by blocks residual blocks of two convolutions each,
+# then, if reduce is set, by one unpadded convolution. dense lists the widths
+# of the fully connected layers before the policy and value heads.
+ARCHITECTURES = {
+    "classic": {
+        "width": 256,
+        "kernel": 0,
+        "convs": 3,
+        "blocks": 0,
+        "reduce": True,
+        "dense": [256, 512],
+    },
+    "small": {
+        "width": 32,
+        "kernel": 3,
+        "convs": 2,
+        "blocks": 0,
+        "reduce": False,
+        "dense": [64],
+    },
+    "residual": {
+        "width": 64,
+        "kernel": 3,
+        "convs": 1,
+        "blocks": 3,
+        "reduce": False,
+        "dense": [128],
+    },
+    "large": {
+        "width": 128,
+        "kernel": 3,
+        "convs": 1,
+        "blocks": 6,
+        "reduce": False,
+        "dense": [256],
+    },
+}
+
+
+def configure(**settings):
+    """Change SETTINGS. They apply when TensorFlow is first imported."""
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings {sorted(unknown)}.")
+    if _TENSORFLOW is not None and any(
+        SETTINGS[key] != value for key, value in settings.items()
+    ):
+        raise RuntimeError("TensorFlow is already running.")
+    SETTINGS.update(settings)
+
+
+def keras():
+    """Import TensorFlow if needed, and return its Keras module.
+
+    Importing TensorFlow takes seconds and hundreds of megabytes, so it only
+    happens once a network is built or loaded. Processes which play with the
+    NumPy backend never import it.
+    """
+    global _TENSORFLOW
+    if _TENSORFLOW is None:
+        import tensorflow
+
+        threading = tensorflow.config.threading
+        threading.set_intra_op_parallelism_threads(SETTINGS["intra_op_threads"])
+        threading.set_inter_op_parallelism_threads(SETTINGS["inter_op_threads"])
+        for gpu in tensorflow.config.list_physical_devices("GPU"):
+            tensorflow.config.experimental.set_memory_growth(
+                gpu, SETTINGS["memory_growth"]
+            )
+        _TENSORFLOW = tensorflow
+    return _TENSORFLOW.keras
+
+
+def architecture(choice: Union[str, Dict]) -> Dict:
+    """Look up a preset by name, or fill in a dict from the classic preset."""
+    if isinstance(choice, str):
+        if choice not in ARCHITECTURES:
+            raise ValueError(f"Unknown architecture {choice}.")
+        return dict(ARCHITECTURES[choice])
+    return dict(ARCHITECTURES["classic"], **choice)
+
+
+def conv_block(x, width: int, kernel: int, padding: str = "same", activate=True):
+    layers = keras().layers
+    x = layers.Conv2D(width, kernel, padding=padding)(x)
+    x = layers.BatchNormalization(axis=3)(x)
+    return layers.Activation("relu")(x) if activate else x
 
 
 class NeuralNet:
-    def __init__(self, size: int):
-        self.input = Input(shape=(size, size))
-        x_image = Reshape((size, size, 1))(self.input)
+    def __init__(self, size: int, config: Union[str, Dict] = "classic"):
+        config = architecture(config)
+        if config["blocks"] and not config["convs"]:
+            raise ValueError("Residual blocks need a convolution before them.")
+        width, kernel = config["width"], config["kernel"] or size
+        layers = keras().layers
 
-        h_conv1 = Activation("relu")(
-            BatchNormalization(axis=3)(Conv2D(256, size, padding="same")(x_image))
-        )
-        h_conv2 = Activation("relu")(
-            BatchNormalization(axis=3)(Conv2D(256, size, padding="same")(h_conv1))
-        )
-        h_conv3 = Activation("relu")(
-            BatchNormalization(axis=3)(Conv2D(256, size, padding="same")(h_conv2))
-        )
-        h_conv4 = Activation("relu")(
-            BatchNormalization(axis=3)(Conv2D(256, size, padding="valid")(h_conv3))
-        )
-        h_conv4_flat = Flatten()(h_conv4)
+        self.input = layers.Input(shape=(size, size))
+        x = layers.Reshape((size, size, 1))(self.input)
+        for _ in range(config["convs"]):
+            x = conv_block(x, width, kernel)
+        for _ in range(config["blocks"]):
+            y = conv_block(conv_block(x, width, kernel), width, kernel, activate=False)
+            x = layers.Activation("relu")(layers.Add()([x, y]))
+        if config["reduce"]:
+            x = conv_block(x, width, kernel, padding="valid")
+        x = layers.Flatten()(x)
 
-        s_fc1 = Dropout(0.3)(
-            Activation("relu")(BatchNormalization(axis=1)(Dense(256)(h_conv4_flat)))
-        )
-        s_fc2 = Dropout(0.3)(
-            Activation("relu")(BatchNormalization(axis=1)(Dense(512)(s_fc1)))
-        )
+        for units in config["dense"]:
+            x = layers.BatchNormalization(axis=1)(layers.Dense(units)(x))
+            x = layers.Dropout(0.3)(layers.Activation("relu")(x))
 
-        self.pi = Dense(size * size, activation="softmax", name="pi")(s_fc2)
-        self.v = Dense(1, activation="tanh", name="v")(s_fc2)
+        self.pi = layers.Dense(size * size, activation="softmax", name="pi")(x)
+        self.v = layers.Dense(1, activation="tanh", name="v")(x)
 
-        self.model = Model(inputs=self.input, outputs=[self.pi, self.v])
+        self.model = keras().Model(inputs=self.input, outputs=[self.pi, self.v])
         self.model.run_eagerly = False
         self.model.compile(
             loss=["categorical_crossentropy", "mean_squared_error"],
-            optimizer=Adam(0.05),
+            optimizer=keras().optimizers.Adam(0.05),
             run_eagerly=False,
         )
+        self.version = next(VERSIONS)
+
+    def train(self, buffer: ReplayBuffer, epochs: int = 15, batch_size: int = 64):
+        """Fit the network to augmented batches drawn from buffer.
 
-    def train(self, examples: List[Tuple[np.ndarray, np.ndarray, np.ndarray]]):
-        inputs, target_pis, target_vs = list(zip(*examples))
-        inputs = np.asarray(inputs)
-        target_pis = np.asarray(target_pis)
-        target_vs = np.asarray(target_vs)
-        self.model.fit(x=inputs, y=[target_pis, target_vs], batch_size=64, epochs=15)
+        Each epoch draws as many examples as the buffer holds in all of its
+        orientations.
+        """
+        steps = -(-len(buffer) * len(buffer.transforms) // batch_size)
+        self.model.fit(buffer.batches(batch_size), steps_per_epoch=steps, epochs=epochs)
+        self.version = next(VERSIONS)
 
     def predict(self, state: State) -> Tuple[np.ndarray, float]:
-        board = np.array(state.board)[np.newaxis, :, :]
-        pi, v = self.model.predict_on_batch(board)
-        return pi[0], v[0][0]
+        pis, vs = self.predict_boards(np.array(state.board)[np.newaxis, :, :])
+        return pis[0], vs[0]
+
+    def predict_batch(self, states: List[State]) -> Tuple[np.ndarray, np.ndarray]:
+        return self.predict_boards(np.array([state.board for state in states]))
+
+    def predict_boards(self, boards: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        utils.count("network_calls")
+        utils.observe("network_batch_size", len(boards))
+        with utils.timer("network_seconds"):
+            pis, vs = self.model.predict_on_batch(boards)
+        return np.asarray(pis), np.asarray(vs)[:, 0]
 
     def save(self, filename: str):
         self.model.save(filename)
+
+    def nbytes(self) -> int:
+        return sum(weight.nbytes for weight in self.model.get_weights())
+
+    def load(self, filename: str):
+        self.model = keras().models.load_model(filename)
+        self.version = next(VERSIONS)
+
+    @classmethod
+    def from_file(cls, filename: str) -> "NeuralNet":
+        """Load a saved network without building a fresh one first."""
+        nnet = cls.__new__(cls)
+        nnet.load(filename)
+        return nnet
+
+    @classmethod
+    def from_weights(cls, config: str, weights: List[np.ndarray]) -> "NeuralNet":
+        """Rebuild a network from its model's JSON config and weights."""
+        nnet = cls.__new__(cls)
+        nnet.model = keras().models.model_from_json(config)
+        nnet.model.set_weights(weights)
+        nnet.version = next(VERSIONS)
+        return nnet
+
+
+class OrientedNet:
+    """A network trained on a rotated or reflected copy of a game.
+
+    Boards are turned by transform t (see symmetry.py) before being passed to
+    nnet, and its policies are turned back. The wrapped network is not
+    modified, so it can be shared with games in other orientations.
+    """
+
+    def __init__(self, nnet: NeuralNet, t: int):
+        self.nnet = nnet
+        self.t = t
+
+    @property
+    def version(self):
+        return (self.nnet.version, self.t)
+
+    def predict(self, state: State) -> Tuple[np.ndarray, float]:
+        pis, vs = self.predict_batch([state])
+        return pis[0], vs[0]
+
+    def predict_batch(self, states: List[State]) -> Tuple[np.ndarray, np.ndarray]:
+        boards = np.array([symmetry.transform(state.board, self.t) for state in states])
+        pis, vs = self.nnet.predict_boards(boards)
+        size = boards.shape[1]
+        pis = np.array([symmetry.untransform_policy(pi, size, self.t) for pi in pis])
+        return pis, vs
@@ -0,0 +1,320 @@
+"""Network inference with NumPy alone.
+
+A trained NeuralNet is exported to a list of array operations, with each
+batch normalization folded into the convolution or dense layer before it.
+NumpyNet runs these operations directly, so processes which only play moves
+avoid the per-call overhead of Keras and can be started without TensorFlow.
+Its weights can also be saved at a reduced precision, see NumpyNet.quantize;
+this only makes the files smaller.
+
+Classes:
+    NumpyNet
+"""
+
+from collections import Counter
+import json
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from libra.core.neuralnetwork import NeuralNet, VERSIONS
+from libra.core.state import State
+from libra.core import utils
+
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "softmax": softmax,
+}
+
+
+def conv2d(x: np.ndarray, kernel: np.ndarray, padding: str) -> np.ndarray:
+    """Convolve a batch of channels-last images, as Keras's Conv2D does."""
+    kh, kw = kernel.shape[:2]
+    if padding == "same":
+        top, left = (kh - 1) // 2, (kw - 1) // 2
+        x = np.pad(x, ((0, 0), (top, kh - 1 - top), (left, kw - 1 - left), (0, 0)))
+    windows = np.lib.stride_tricks.sliding_window_view(x, (kh, kw), axis=(1, 2))
+    n, h, w = windows.shape[:3]
+    # Lay each window out as (row, column, channel), the order of the kernel.
+    columns = windows.transpose(0, 1, 2, 4, 5, 3).reshape(n * h * w, -1)
+    return (columns @ kernel.reshape(-1, kernel.shape[-1])).reshape(n, h, w, -1)
+
+
+def inbound(layer: Dict) -> List[str]:
+    """The names of the layers feeding a layer in a functional model config."""
+    if len(layer["inbound_nodes"]) > 1:
+        raise ValueError(f"Cannot export shared layer {layer['name']}.")
+    return [node[0] for nodes in layer["inbound_nodes"] for node in nodes]
+
+
+def batchnorm(config: Dict, weights: List[np.ndarray]) -> Tuple[np.ndarray, ...]:
+    """Turn a batch normalization into a scale and shift of its last axis."""
+    weights = list(weights)
+    gamma = weights.pop(0) if config["scale"] else 1.0
+    beta = weights.pop(0) if config["center"] else 0.0
+    mean, variance = weights
+    scale = gamma / np.sqrt(variance + config["epsilon"])
+    return scale, beta - mean * scale
+
+
+def export(model) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """Convert a functional Keras model into operations and their arrays.
+
+    Supports the layers used by NeuralNet: Reshape, Flatten, Conv2D, Dense,
+    BatchNormalization, Activation, Add and Dropout (which does nothing at
+    inference). Raises ValueError for anything else.
+    """
+    config = model.get_config()
+    if len(config["input_layers"]) != 1:
+        raise ValueError("Can only export models with one input.")
+    consumers = Counter(name for layer in config["layers"] for name in inbound(layer))
+
+    ops, arrays = {}, {}
+    # Maps each layer to the operation computing its output.
+    alias = {}
+    for layer in config["layers"]:
+        name, kind, options = layer["name"], layer["class_name"], layer["config"]
+        inputs = [alias[source] for source in inbound(layer)]
+        keras_layer = model.get_layer(name)
+        weights = keras_layer.get_weights()
+        op = {"name": name, "inputs": inputs}
+
+        if kind == "InputLayer":
+            op["op"] = "input"
+        elif kind == "Dropout":
+            alias[name] = inputs[0]
+            continue
+        elif kind == "Reshape":
+            op.update(op="reshape", shape=list(options["target_shape"]))
+        elif kind == "Flatten":
+            op.update(op="reshape", shape=[-1])
+        elif kind in ("Conv2D", "Dense"):
+            if kind == "Conv2D" and (
+                tuple(options["strides"]) != (1, 1)
+                or tuple(options["dilation_rate"]) != (1, 1)
+                or options.get("groups", 1) != 1
+                or options["data_format"] != "channels_last"
+            ):
+                raise ValueError(f"Cannot export convolution {name}.")
+            kernel = weights[0]
+            bias = weights[1] if options["use_bias"] else np.zeros(kernel.shape[-1])
+            arrays[name + ".kernel"] = kernel
+            arrays[name + ".bias"] = bias
+            op.update(op=kind.lower(), activation=options["activation"])
+            if kind == "Conv2D":
+                op["padding"] = options["padding"]
+        elif kind == "BatchNormalization":
+            axis = options["axis"]
+            axis = axis[0] if isinstance(axis, list) and len(axis) == 1 else axis
+            if axis not in (-1, len(keras_layer.output_shape) - 1):
+                raise ValueError(f"Cannot export normalization {name}.")
+            scale, shift = batchnorm(options, weights)
+            source = ops.get(inputs[0])
+            if (
+                source is not None
+                and source["op"] in ("conv2d", "dense")
+                and source["activation"] == "linear"
+                and consumers[source["name"]] == 1
+            ):
+                arrays[source["name"] + ".kernel"] = (
+                    arrays[source["name"] + ".kernel"] * scale
+                )
+                arrays[source["name"] + ".bias"] = (
+                    arrays[source["name"] + ".bias"] * scale + shift
+                )
+                alias[name] = inputs[0]
+                continue
+            arrays[name + ".scale"] = scale
+            arrays[name + ".shift"] = shift
+            op["op"] = "affine"
+        elif kind == "Activation":
+            op.update(op="activation", activation=options["activation"])
+        elif kind == "Add":
+            op["op"] = "add"
+        else:
+            raise ValueError(f"Cannot export {kind} layer {name}.")
+
+        if op.get("activation", "linear") not in ACTIVATIONS:
+            raise ValueError(f"Cannot export activation {op['activation']}.")
+        ops[name] = op
+        alias[name] = name
+
+    spec = {
+        "ops": list(ops.values()),
+        "outputs": [alias[output[0]] for output in config["output_layers"]],
+    }
+    arrays = {key: np.asarray(value, np.float32) for key, value in arrays.items()}
+    return spec, arrays
+
+
+class NumpyNet:
+    """An inference-only copy of a NeuralNet, run with NumPy.
+
+    It evaluates positions through the same predict, predict_batch and
+    predict_boards methods as NeuralNet, so MCTS, the evaluation cache and
+    OrientedNet can use either. It cannot be trained.
+
+    Attributes:
+        spec: the operations making up the network, and its outputs;
+        arrays: the weights of the operations, by "<operation>.<name>", all
+            in float32;
+        stored: the dtype each array is saved in, where not float32;
+        precision: "float32", "float16" or "int8", see quantize;
+        version: see neuralnetwork.VERSIONS.
+    """
+
+    def __init__(self, spec: Dict, arrays: Dict[str, np.ndarray]):
+        self.spec = spec
+        # NumPy has no fast float16 or int8 products, so reduced precision
+        # weights are widened once here rather than on every call. Widening is
+        # exact, and save narrows them again.
+        self.stored = {
+            key: array.dtype
+            for key, array in arrays.items()
+            if array.dtype != np.float32
+        }
+        self.arrays = {
+            key: np.asarray(array, np.float32) for key, array in arrays.items()
+        }
+        self.precision = spec.get("precision", "float32")
+        self.version = next(VERSIONS)
+
+    @classmethod
+    def from_keras(cls, nnet: NeuralNet) -> "NumpyNet":
+        return cls(*export(nnet.model))
+
+    @classmethod
+    def from_file(cls, filename: str) -> "NumpyNet":
+        with np.load(filename) as data:
+            spec = json.loads(str(data["spec"]))
+            arrays = {key: data[key] for key in data.files if key != "spec"}
+        return cls(spec, arrays)
+
+    def save(self, filename: str):
+        arrays = {
+            key: array.astype(self.stored.get(key, np.float32))
+            for key, array in self.arrays.items()
+        }
+        np.savez(filename, spec=np.array(json.dumps(self.spec)), **arrays)
+
+    def nbytes(self) -> int:
+        """The memory used by the weights, which are float32 at any precision."""
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def stored_nbytes(self) -> int:
+        """The size of the weights as saved, at the network's precision."""
+        return sum(
+            array.size * np.dtype(self.stored.get(key, np.float32)).itemsize
+            for key, array in self.arrays.items()
+        )
+
+    def predict(self, state: State) -> Tuple[np.ndarray, float]:
+        pis, vs = self.predict_boards(np.array(state.board)[np.newaxis, :, :])
+        return pis[0], vs[0]
+
+    def predict_batch(self, states: List[State]) -> Tuple[np.ndarray, np.ndarray]:
+        return self.predict_boards(np.array([state.board for state in states]))
+
+    def predict_boards(self, boards: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        utils.count("network_calls")
+        utils.observe("network_batch_size", len(boards))
+        with utils.timer("network_seconds"):
+            pis, vs = self.run(np.asarray(boards, np.float32))
+        return pis, vs[:, 0]
+
+    def quantize(
+        self, precision: str, boards: Optional[np.ndarray] = None
+    ) -> "NumpyNet":
+        """Copy the network, storing its convolution and dense kernels at a lower
+        precision.
+
+        float16 halves the saved size of the kernels. int8 quarters it, with
+        one scale per output channel, and also rounds the input of each layer
+        to int8 as an int8 runtime would. The range of those inputs is
+        calibrated on boards, which should be positions from self-play.
+
+        This is a storage format, not a faster backend: NumPy has no fast
+        float16 or int8 products, so the kernels are held and multiplied in
+        float32, and a quantized network is as fast and uses as much memory as
+        the float32 one. Only its files are smaller, and its results rounded.
+        """
+        if self.precision != "float32":
+            raise ValueError("Can only quantize a float32 network.")
+        if precision not in ("float16", "int8"):
+            raise ValueError(f"Unknown precision {precision}.")
+        if precision == "int8" and boards is None:
+            raise ValueError("int8 needs boards to calibrate on.")
+        if precision == "int8":
+            values = self.evaluate(np.asarray(boards, np.float32))
+
+        arrays = dict(self.arrays)
+        for op in self.spec["ops"]:
+            if op["op"] not in ("conv2d", "dense"):
+                continue
+            kernel = arrays[op["name"] + ".kernel"]
+            if precision == "float16":
+                arrays[op["name"] + ".kernel"] = kernel.astype(np.float16)
+                continue
+            scale = np.abs(kernel).reshape(-1, kernel.shape[-1]).max(axis=0) / 127
+            scale[scale == 0] = 1
+            arrays[op["name"] + ".kernel"] = np.round(kernel / scale).astype(np.int8)
+            arrays[op["name"] + ".kernel_scale"] = scale.astype(np.float32)
+            # A high percentile rather than the maximum, so that rare outliers
+            # are clipped instead of costing every other value its precision.
+            bound = np.percentile(np.abs(values[op["inputs"][0]]), 99.99)
+            arrays[op["name"] + ".input_scale"] = np.float32(max(bound, 1e-6) / 127)
+        return NumpyNet(dict(self.spec, precision=precision), arrays)
+
+    def linear(self, op: Dict, x: np.ndarray) -> np.ndarray:
+        """Apply the kernel and bias of a convolution or dense layer."""
+        kernel = self.arrays[op["name"] + ".kernel"]
+        rescale = None
+        if op["name"] + ".input_scale" in self.arrays:
+            scale = self.arrays[op["name"] + ".input_scale"]
+            x = np.clip(np.round(x / scale), -127, 127)
+            rescale = self.arrays[op["name"] + ".kernel_scale"] * scale
+        if op["op"] == "conv2d":
+            out = conv2d(x, kernel, op["padding"])
+        else:
+            out = x @ kernel
+        if rescale is not None:
+            out *= rescale
+        out += self.arrays[op["name"] + ".bias"]
+        return out
+
+    def run(self, boards: np.ndarray) -> List[np.ndarray]:
+        values = self.evaluate(boards)
+        return [values[name] for name in self.spec["outputs"]]
+
+    def evaluate(self, boards: np.ndarray) -> Dict[str, np.ndarray]:
+        """Compute the output of every operation."""
+        values = {}
+        for op in self.spec["ops"]:
+            x = [values[name] for name in op["inputs"]]
+            kind = op["op"]
+            if kind == "input":
+                out = boards
+            elif kind == "reshape":
+                out = x[0].reshape((len(x[0]),) + tuple(op["shape"]))
+            elif kind in ("conv2d", "dense"):
+                out = self.linear(op, x[0])
+            elif kind == "affine":
+                out = x[0] * self.arrays[op["name"] + ".scale"]
+                out += self.arrays[op["name"] + ".shift"]
+            elif kind == "add":
+                out = sum(x[1:], x[0])
+            else:
+                out = x[0]
+            if "activation" in op:
+                out = ACTIVATIONS[op["activation"]](out)
+            values[op["name"]] = out
+        return values
@@ -0,0 +1,88 @@
+"""A process-wide registry of trained models loaded from disk.
+
+Classes:
+    Registry
+"""
+
+from collections import OrderedDict
+import os
+import threading
+
+from libra.core.neuralnetwork import NeuralNet
+from libra.core.numpynet import NumpyNet
+from libra.core.remote import RemoteNet
+from libra.core import utils
+
+
+# The files saved next to a Keras model for each NumPy backend.
+EXPORTS = {"numpy": ".npz"}
+
+
+def read(filename: str, backend: str):
+    """Read a model from disk, converting it if it has no export for backend.
+
+    The "remote" backend loads nothing, and evaluates with the inference
+    server.
+    """
+    if backend == "keras":
+        return NeuralNet.from_file(filename)
+    if backend == "remote":
+        return RemoteNet(filename)
+    if backend not in EXPORTS:
+        raise ValueError(f"Unknown backend {backend}.")
+    if os.path.exists(filename + EXPORTS[backend]):
+        return NumpyNet.from_file(filename + EXPORTS[backend])
+    return NumpyNet.from_keras(NeuralNet.from_file(filename))
+
+
+class Registry:
+    """An LRU cache of loaded networks, bounded by the size of their weights.
+
+    Each saved model is loaded at most once while it stays in the registry,
+    and the same NeuralNet is handed to every game that asks for it. Games only
+    read from their network (training works on a copy), so sharing it is safe.
+    Evicted networks stay usable by the games which already hold them.
+
+    Attributes:
+        capacity: the most bytes of weights kept loaded;
+        entries: maps each filename and backend to the network and the bytes
+            it uses.
+    """
+
+    def __init__(self, capacity: int = 1 << 30):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, filename: str, backend: str = "keras"):
+        """Load a model with the "keras" or "remote" backend, or one in EXPORTS."""
+        with self.lock:
+            key = (filename, backend)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+
+            nnet = read(filename, backend)
+            size = nnet.nbytes()
+            self.entries[key] = (nnet, size)
+            utils.debug("Loaded %s model %s (%d bytes).", backend, filename, size)
+
+            while len(self.entries) > 1 and self.nbytes() > self.capacity:
+                evicted, _ = self.entries.popitem(last=False)
+                utils.debug("Evicted model %s.", evicted)
+            return nnet
+
+    def nbytes(self) -> int:
+        return sum(size for _, size in self.entries.values())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+REGISTRY = Registry()
+
+
+def load(filename: str, backend: str = "keras"):
+    """Load the model saved in filename, sharing it if already loaded."""
+    return REGISTRY.load(filename, backend)
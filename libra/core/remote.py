@@ -0,0 +1,103 @@
+"""Network evaluations served by another process.
+
+A RemoteNet sends the positions it is asked to evaluate to an inference
+server (see server.py), which owns the loaded models and batches the requests
+of every client together. Processes which only play moves then need neither
+TensorFlow nor a copy of the weights.
+
+Classes:
+    RemoteNet
+"""
+
+import os
+import threading
+from multiprocessing.connection import Client
+from typing import List, Tuple
+
+import numpy as np
+
+from libra.core.neuralnetwork import VERSIONS
+from libra.core.state import State
+from libra.core import utils
+
+# Where clients find the inference server. The address is a Unix socket path
+# and authkey a shared secret, as for multiprocessing.connection. timeout is
+# the most seconds to wait for an answer.
+SETTINGS = {"address": "libra-inference.sock", "authkey": "libra", "timeout": 10.0}
+
+
+def configure(**settings):
+    """Change SETTINGS. Connections made before keep the old ones."""
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings {sorted(unknown)}.")
+    SETTINGS.update(settings)
+
+
+class RemoteNet:
+    """A network evaluated by the inference server.
+
+    It has the predict, predict_batch and predict_boards methods of NeuralNet,
+    so MCTS, the evaluation cache and OrientedNet can use it in the same way.
+    Each thread keeps its own connection, which is reopened once if the server
+    has restarted. It cannot be trained.
+
+    Attributes:
+        filename: the absolute path of the Keras model evaluated;
+        version: see neuralnetwork.VERSIONS.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = os.path.abspath(filename)
+        self.version = next(VERSIONS)
+        self.local = threading.local()
+
+    def nbytes(self) -> int:
+        # The weights are held by the server.
+        return 0
+
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = Client(
+                SETTINGS["address"], authkey=SETTINGS["authkey"].encode()
+            )
+        return self.local.connection
+
+    def request(self, boards: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        message = ("predict", self.filename, boards)
+        for attempt in range(2):
+            try:
+                connection = self.connection()
+                connection.send(message)
+                answered = connection.poll(SETTINGS["timeout"])
+                if answered:
+                    status, reply = connection.recv()
+                break
+            except (EOFError, OSError):
+                self.local.connection = None
+                if attempt:
+                    raise
+                utils.debug("Reconnecting to inference server.")
+        if not answered:
+            # A late answer would be taken for the next request's.
+            connection.close()
+            self.local.connection = None
+            raise TimeoutError(
+                f"Inference server gave no answer in {SETTINGS['timeout']} seconds."
+            )
+        if status != "ok":
+            raise RuntimeError(f"Inference server failed: {reply}")
+        return reply
+
+    def predict(self, state: State) -> Tuple[np.ndarray, float]:
+        pis, vs = self.predict_boards(np.array(state.board)[np.newaxis, :, :])
+        return pis[0], vs[0]
+
+    def predict_batch(self, states: List[State]) -> Tuple[np.ndarray, np.ndarray]:
+        return self.predict_boards(np.array([state.board for state in states]))
+
+    def predict_boards(self, boards: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        utils.count("remote_calls")
+        utils.observe("remote_batch_size", len(boards))
+        with utils.timer("remote_seconds"):
+            return self.request(np.asarray(boards, np.int8))
@@ -0,0 +1,144 @@
+"""A bounded store of self-play examples to train on.
+
+Classes:
+    ReplayBuffer
+"""
+
+import json
+import os
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from libra.core import symmetry
+
+
+class ReplayBuffer:
+    """A ring buffer of training examples in preallocated arrays.
+
+    Once full, each new example overwrites the oldest one. Examples are stored
+    in a single orientation; batches are augmented as they are drawn, by
+    turning each example with a random transform (see symmetry.py) from those
+    which leave the game unchanged.
+
+    Given a directory, the arrays are memory-mapped .npy files there, with the
+    count of examples added kept in buffer.json, so that training can be
+    resumed with the same examples after a restart.
+
+    Attributes:
+        capacity: the most examples kept;
+        size: the size of the game board;
+        transforms: the transforms used for augmentation;
+        half_life: if set, batches favour recent examples, an example that
+            many additions old being drawn half as often as the newest;
+            otherwise all stored examples are drawn equally often;
+        directory: where the examples are stored, if on disk;
+        boards, pis, vs: the stored positions, policies and values;
+        added: the number of examples ever added.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        size: int,
+        transforms: Sequence[int] = range(8),
+        half_life: Optional[float] = None,
+        directory: Optional[str] = None,
+        resume: bool = False,
+    ):
+        """Create an empty buffer, or if resume is set, open the one stored in
+        directory."""
+        self.capacity = capacity
+        self.size = size
+        self.transforms = list(transforms)
+        self.half_life = half_life
+        self.directory = directory
+        self.added = 0
+        shapes = {
+            "boards": ((capacity, size, size), np.int8),
+            "pis": ((capacity, size * size), np.float32),
+            "vs": ((capacity, 1), np.float32),
+        }
+
+        if directory is None:
+            for name, (shape, dtype) in shapes.items():
+                setattr(self, name, np.zeros(shape, dtype))
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        if resume:
+            with open(os.path.join(directory, "buffer.json")) as f:
+                meta = json.load(f)
+            if (meta["capacity"], meta["size"]) != (capacity, size):
+                raise ValueError(
+                    f"{directory} holds a buffer of {meta['capacity']} examples "
+                    f"of size {meta['size']}."
+                )
+            self.added = meta["added"]
+        for name, (shape, dtype) in shapes.items():
+            filename = os.path.join(directory, name + ".npy")
+            if resume:
+                array = np.lib.format.open_memmap(filename, mode="r+")
+            else:
+                array = np.lib.format.open_memmap(
+                    filename, mode="w+", dtype=dtype, shape=shape
+                )
+            setattr(self, name, array)
+        self.flush()
+
+    def __len__(self) -> int:
+        return min(self.added, self.capacity)
+
+    def add(self, boards: np.ndarray, pis: np.ndarray, vs: np.ndarray):
+        """Add a batch of examples, overwriting the oldest ones if full."""
+        count = len(boards)
+        keep = min(count, self.capacity)
+        slots = (self.added + np.arange(count - keep, count)) % self.capacity
+        self.boards[slots] = boards[count - keep :]
+        self.pis[slots] = pis[count - keep :]
+        self.vs[slots] = np.reshape(vs, (-1, 1))[count - keep :]
+        self.added += count
+        if self.directory is not None:
+            self.flush()
+
+    def flush(self):
+        """Write the examples to disk, then the count which makes them valid."""
+        for array in (self.boards, self.pis, self.vs):
+            array.flush()
+        meta = {"capacity": self.capacity, "size": self.size, "added": self.added}
+        filename = os.path.join(self.directory, "buffer.json")
+        with open(filename + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(filename + ".tmp", filename)
+
+    def extend(self, examples: List[Tuple[np.ndarray, np.ndarray, np.ndarray]]):
+        if examples:
+            boards, pis, vs = zip(*examples)
+            self.add(np.asarray(boards), np.asarray(pis), np.asarray(vs))
+
+    def sample(self, count: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Draw count augmented examples, with replacement."""
+        stored = len(self)
+        if self.half_life is None:
+            slots = np.random.randint(stored, size=count)
+        else:
+            # Ages run from 0 for the newest example to stored - 1.
+            ages = (self.added - 1 - np.arange(stored)) % self.capacity
+            weights = 0.5 ** (ages / self.half_life)
+            slots = np.random.choice(stored, size=count, p=weights / weights.sum())
+        boards = self.boards[slots].reshape(count, -1)
+        pis = self.pis[slots]
+        chosen = np.random.choice(self.transforms, size=count)
+        for t in self.transforms:
+            rows = np.flatnonzero(chosen == t)
+            p = symmetry.permutation(self.size, t)
+            boards[rows] = boards[rows][:, p]
+            pis[rows] = pis[rows][:, p]
+        boards = boards.reshape(count, self.size, self.size).astype(np.float32)
+        return boards, pis, self.vs[slots]
+
+    def batches(self, batch_size: int) -> Iterator[Tuple[np.ndarray, List]]:
+        """Draw batches forever, in the form Keras's fit expects."""
+        while True:
+            boards, pis, vs = self.sample(batch_size)
+            yield boards, [pis, vs]
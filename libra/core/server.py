@@ -0,0 +1,237 @@
+"""A local inference server shared by the processes playing moves.
+
+Run with `python -m libra.core.server`. The server loads models through its
+own registry (see registry.py) and evaluates positions for RemoteNet clients
+(see remote.py) connecting over a Unix socket. Requests which arrive within a
+few milliseconds of each other are evaluated in one network call per model,
+so that concurrent games share the cost of inference.
+
+Classes:
+    InferenceServer
+"""
+
+import argparse
+import os
+import queue
+import stat
+import threading
+import time
+from multiprocessing.connection import Listener
+from typing import List
+
+import numpy as np
+
+from libra.core import registry, remote, utils
+
+
+class Request:
+    """Positions to evaluate with one model, and the answer once it is ready."""
+
+    def __init__(self, filename: str, boards: np.ndarray):
+        self.filename = filename
+        self.boards = boards
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.reply = None
+
+
+class InferenceServer:
+    """Evaluates positions for clients, batching requests across them.
+
+    Each client connection is served by its own thread, which queues the
+    requests it receives and waits for their answers. A single batching thread
+    takes the first queued request, gathers any more arriving within window
+    seconds, up to max_batch positions in all, and evaluates them together.
+
+    Attributes:
+        address: the Unix socket path listened on;
+        authkey: the secret clients must know;
+        backend: "keras", or "numpy" (see registry.read);
+        window: the longest a request waits for others to batch with;
+        max_batch: the most positions evaluated in one batch;
+        registry: the models loaded;
+        requests: the queue of requests to evaluate.
+    """
+
+    def __init__(
+        self,
+        address: str = remote.SETTINGS["address"],
+        authkey: str = remote.SETTINGS["authkey"],
+        backend: str = "numpy",
+        window: float = 0.005,
+        max_batch: int = 256,
+        capacity: int = 1 << 30,
+    ):
+        self.address = address
+        self.authkey = authkey
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self.registry = registry.Registry(capacity)
+        self.requests = queue.Queue()
+
+    def serve(self):
+        """Accept clients until interrupted."""
+        if os.path.exists(self.address) and stat.S_ISSOCK(
+            os.stat(self.address).st_mode
+        ):
+            # Left behind by a server which did not shut down cleanly.
+            os.remove(self.address)
+        threading.Thread(target=self.batch_loop, daemon=True).start()
+        with Listener(self.address, authkey=self.authkey.encode()) as listener:
+            utils.info("Serving %s models on %s.", self.backend, self.address)
+            while True:
+                try:
+                    connection = listener.accept()
+                except OSError as e:
+                    # Includes clients failing authentication.
+                    utils.warn("Rejected client: %s", e)
+                    continue
+                threading.Thread(
+                    target=self.handle, args=(connection,), daemon=True
+                ).start()
+
+    def handle(self, connection):
+        """Answer the requests of one client until it disconnects."""
+        with connection:
+            while True:
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    # The message arrived whole but could not be unpickled.
+                    message = e
+                try:
+                    request = self.request(message)
+                except ValueError as e:
+                    utils.warn("Bad request: %s", e)
+                    reply = ("error", str(e))
+                else:
+                    self.requests.put(request)
+                    request.done.wait()
+                    reply = request.reply
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+
+    def request(self, message) -> Request:
+        """Check a message from a client and turn it into a Request."""
+        try:
+            kind, filename, boards = message
+        except (TypeError, ValueError):
+            raise ValueError(f"Malformed request {message!r:.80}.")
+        if kind != "predict":
+            raise ValueError(f"Unknown request {kind!r:.80}.")
+        if not isinstance(filename, str):
+            raise ValueError("Model filenames must be strings.")
+        boards = np.asarray(boards)
+        if boards.ndim != 3 or boards.shape[1] != boards.shape[2]:
+            raise ValueError(f"Boards of shape {boards.shape} are not square.")
+        return Request(filename, boards)
+
+    def batch_loop(self):
+        while True:
+            batch = self.gather()
+            utils.observe("server_requests_per_batch", len(batch))
+            try:
+                self.evaluate(batch)
+            except Exception as e:
+                # Nothing may stop this thread, or every client would wait.
+                utils.warn("Failed to evaluate a batch: %r", e)
+                for request in batch:
+                    if not request.done.is_set():
+                        request.reply = ("error", repr(e))
+                        request.done.set()
+
+    def gather(self) -> List[Request]:
+        """Wait for a request, then for more until the window closes or the
+        batch is full."""
+        batch = [self.requests.get()]
+        positions = len(batch[0].boards)
+        deadline = time.perf_counter() + self.window
+        while positions < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            positions += len(request.boards)
+        return batch
+
+    def evaluate(self, batch: List[Request]):
+        """Evaluate a batch with one network call per model."""
+        models = {}
+        for request in batch:
+            models.setdefault(request.filename, []).append(request)
+
+        for filename, requests in models.items():
+            try:
+                replies = self.predict(filename, requests)
+            except Exception as e:
+                if len(requests) == 1:
+                    utils.warn("Failed to evaluate with %s: %r", filename, e)
+                    replies = [("error", repr(e))]
+                else:
+                    # Answer each request alone, so one bad request only fails
+                    # its own client.
+                    self.evaluate(requests[:1])
+                    self.evaluate(requests[1:])
+                    continue
+
+            now = time.perf_counter()
+            for request, reply in zip(requests, replies):
+                utils.observe(
+                    "server_latency_seconds", now - request.received, utils.TIME_BUCKETS
+                )
+                request.reply = reply
+                request.done.set()
+
+    def predict(self, filename: str, requests: List[Request]) -> List:
+        """Evaluate the requests for one model in one network call."""
+        nnet = self.registry.load(filename, self.backend)
+        boards = np.concatenate([request.boards for request in requests])
+        pis, vs = nnet.predict_boards(boards)
+        splits = np.cumsum([len(request.boards) for request in requests])[:-1]
+        return [
+            ("ok", answer)
+            for answer in zip(np.split(pis, splits), np.split(vs, splits))
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--address", default=remote.SETTINGS["address"])
+    parser.add_argument("--authkey", default=remote.SETTINGS["authkey"])
+    parser.add_argument(
+        "--backend", choices=["keras"] + list(registry.EXPORTS), default="numpy"
+    )
+    parser.add_argument(
+        "--window", type=float, default=5, help="milliseconds to gather a batch"
+    )
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--capacity", type=int, default=1 << 30)
+    args = parser.parse_args()
+
+    server = InferenceServer(
+        args.address,
+        args.authkey,
+        args.backend,
+        args.window / 1000,
+        args.max_batch,
+        args.capacity,
+    )
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
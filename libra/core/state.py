@@ -1,50 +1,199 @@
-import copy
 import random
 from typing import List, Optional
 
 import numpy as np
-import xxhash
+
+from libra.core import symmetry
+
+_ZOBRIST = {}
+_RULES = {}
+
+
+def zobrist(size: int):
+    """Random keys for each (cell, colour) pair of a size x size board."""
+    if size not in _ZOBRIST:
+        rng = random.Random(size)
+        cells = size * size
+        _ZOBRIST[size] = (
+            [rng.getrandbits(64) for _ in range(cells)],
+            [rng.getrandbits(64) for _ in range(cells)],
+        )
+    return _ZOBRIST[size]
+
+
+def unpack(mask: int, cells: int) -> np.ndarray:
+    """Expand the low cells bits of mask into an array of 0s and 1s."""
+    data = np.frombuffer(mask.to_bytes((cells + 7) // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(data, count=cells, bitorder="little")
+
+
+class Rules:
+    """The winning placements of a set of shapes on a size x size board.
+
+    A placement is a bitmask of the cells covered by the nonzero entries of a
+    shape at one offset; a player who holds all of them wins. covering[i] lists
+    the placements which include cell i. matrix has one column per placement,
+    with a 1 for each of its cells, for checking many boards at once.
+    symmetries lists the transforms (see symmetry.py) which leave the set of
+    placements unchanged. Rules are shared between all states with the same
+    size and shapes, see rules().
+    """
+
+    def __init__(self, size: int, shapes: List[np.ndarray]):
+        self.size = size
+        self.own_keys, self.opp_keys = zobrist(size)
+        self.placements = []
+        self.covering = [[] for _ in range(size * size)]
+        for shape in shapes:
+            rows, cols = shape.shape
+            cells = [int(r * size + c) for r, c in zip(*np.nonzero(shape))]
+            if not cells:
+                continue
+            for i in range(size - rows + 1):
+                for j in range(size - cols + 1):
+                    mask = 0
+                    for cell in cells:
+                        mask |= 1 << (cell + i * size + j)
+                    self.placements.append(mask)
+                    for cell in cells:
+                        self.covering[cell + i * size + j].append(mask)
+        self.matrix = np.zeros((size * size, len(self.placements)), dtype=np.float32)
+        for p, mask in enumerate(self.placements):
+            self.matrix[:, p] = unpack(mask, size * size)
+        self.counts = self.matrix.sum(axis=0)
+        self.symmetries = symmetry.group(size, self.matrix)
+
+
+def rules(size: int, shapes: List[np.ndarray]) -> Rules:
+    key = (size, tuple((shape.shape, np.asarray(shape).tobytes()) for shape in shapes))
+    if key not in _RULES:
+        _RULES[key] = Rules(size, shapes)
+    return _RULES[key]
+
+
+def batch_result(boards: np.ndarray, shapes: List[np.ndarray]) -> np.ndarray:
+    """Find the results of a stack of boards, as State.result would.
+
+    Returns an array with 1, -1 or 0 for each finished board and NaN for each
+    board whose game is still in progress.
+    """
+    boards = np.asarray(boards)
+    count, size = boards.shape[0], boards.shape[-1]
+    table = rules(size, shapes)
+    flat = boards.reshape((count, size * size))
+
+    res = np.full(count, np.nan)
+    res[(flat != 0).all(axis=1)] = 0
+    if not table.placements:
+        return res
+
+    own = (flat == 1).astype(np.float32) @ table.matrix == table.counts
+    opp = (flat == -1).astype(np.float32) @ table.matrix == table.counts
+    won = own | opp
+    # Like State.result, the first completed placement decides the winner.
+    rows = np.flatnonzero(won.any(axis=1))
+    first = won[rows].argmax(axis=1)
+    res[rows] = np.where(own[rows, first], 1.0, -1.0)
+    return res
 
 
 class State:
+    """A board position, seen from the side of the player to move.
+
+    The stones of the player to move and of their opponent are stored as two
+    bitmasks, own and opp, with bit i standing for cell i of the flattened
+    board. key is a Zobrist hash of the position and flip the hash of the same
+    stones with the colours swapped, which lets move() update both in O(1).
+    last is the cell of the previous move, if known.
+    """
+
+    __slots__ = (
+        "size",
+        "shapes",
+        "rules",
+        "own",
+        "opp",
+        "key",
+        "flip",
+        "last",
+        "_board",
+    )
+
     def __init__(self, size: int, board: np.ndarray, shapes: List[np.ndarray]):
         self.size = size
-        self.board = board
         self.shapes = shapes
-        super().__init__()
+        self.rules = rules(size, shapes)
+        self.own = self.opp = self.key = self.flip = 0
+        own_keys, opp_keys = self.rules.own_keys, self.rules.opp_keys
+        for i, x in enumerate(np.asarray(board).flatten()):
+            if x == 1:
+                self.own |= 1 << i
+                self.key ^= own_keys[i]
+                self.flip ^= opp_keys[i]
+            elif x == -1:
+                self.opp |= 1 << i
+                self.key ^= opp_keys[i]
+                self.flip ^= own_keys[i]
+        self.last = None
+        self._board = None
+
+    @property
+    def board(self) -> np.ndarray:
+        """The position as a read-only array of 1 (own), -1 (opp) and 0."""
+        if self._board is None:
+            cells = self.size * self.size
+            board = unpack(self.own, cells) - unpack(self.opp, cells).astype(float)
+            board = board.reshape((self.size, self.size))
+            board.flags.writeable = False
+            self._board = board
+        return self._board
 
     def result(self) -> Optional[int]:
-        for shape in self.shapes:
-            rows, cols = shape.shape
-            count = np.sum(shape * shape)
-            for i in range(self.size - rows + 1):
-                for j in range(self.size - cols + 1):
-                    cur = np.sum(self.board[i : i + rows, j : j + cols] * shape)
-                    if abs(cur) == count:
-                        return cur // count
-
-        if (self.board != 0).all():
+        if self.last is not None:
+            # Only the player who just moved can have completed a shape, and
+            # only one which covers their move.
+            for mask in self.rules.covering[self.last]:
+                if (self.opp & mask) == mask:
+                    return -1
+        else:
+            for mask in self.rules.placements:
+                if (self.own & mask) == mask:
+                    return 1
+                if (self.opp & mask) == mask:
+                    return -1
+
+        if (self.own | self.opp) == (1 << self.size * self.size) - 1:
             return 0
 
         return None
 
     def moves(self) -> np.ndarray:
-        return (self.board == 0).flatten().astype(int)
+        cells = self.size * self.size
+        empty = ~(self.own | self.opp) & ((1 << cells) - 1)
+        return unpack(empty, cells).astype(int)
 
     def move(self, index: int) -> "State":
-        new_board = self.board.flatten()
-        new_board[index] = 1
-        new_board *= -1
-        new_board = np.reshape(new_board, (self.size, self.size))
-        return State(self.size, new_board, self.shapes)
+        index = int(index)
+        state = State.__new__(State)
+        state.size = self.size
+        state.shapes = self.shapes
+        state.rules = self.rules
+        state.own = self.opp
+        state.opp = self.own | (1 << index)
+        state.key = self.flip ^ self.rules.opp_keys[index]
+        state.flip = self.key ^ self.rules.own_keys[index]
+        state.last = index
+        state._board = None
+        return state
 
     def __hash__(self) -> int:
-        hasher = xxhash.xxh64()
-        hasher.update(self.board)
-        return hasher.intdigest()
+        return self.key
 
     def __eq__(self, other: "State") -> bool:
-        return (self.board == other.board).all()
+        return self.own == other.own and self.opp == other.opp
+
+    def __reduce__(self):
+        return State, (self.size, self.board, self.shapes)
 
     def __str__(self, p=1) -> str:
         return "\n" + "\n".join(
@@ -0,0 +1,92 @@
+"""Rotations and reflections of a square board.
+
+A transform is a number t from 0 to 7: the board is turned by t % 4 quarter
+turns, and then reflected left to right if t >= 4.
+"""
+
+import functools
+import hashlib
+from typing import List, Tuple
+
+import numpy as np
+
+
+def transform(board: np.ndarray, t: int) -> np.ndarray:
+    board = np.rot90(board, t % 4)
+    return np.fliplr(board) if t >= 4 else board
+
+
+@functools.lru_cache(maxsize=None)
+def permutation(size: int, t: int) -> np.ndarray:
+    """Find p such that transform(board, t).flatten() == board.flatten()[p]."""
+    return transform(np.arange(size * size).reshape((size, size)), t).flatten()
+
+
+def group(size: int, matrix: np.ndarray) -> List[int]:
+    """Find the transforms which map a set of winning placements to itself.
+
+    matrix has one column per placement, as in state.Rules. These are the
+    transforms under which the game is unchanged.
+    """
+    placements = {column.tobytes() for column in matrix.T}
+    return [
+        t
+        for t in range(8)
+        if {column.tobytes() for column in matrix[permutation(size, t)].T} == placements
+    ]
+
+
+def canonical(board: np.ndarray, transforms: List[int]) -> Tuple[int, bytes]:
+    """Pick one orientation of board to stand for all of its symmetric copies.
+
+    Returns the transform which gives it and a key identifying it.
+    """
+    size = board.shape[0]
+    flat = board.flatten().astype(np.int8)
+    best, key = 0, None
+    for t in transforms:
+        candidate = flat[permutation(size, t)].tobytes()
+        if key is None or candidate < key:
+            best, key = t, candidate
+    return best, key
+
+
+def untransform_policy(policy: np.ndarray, size: int, t: int) -> np.ndarray:
+    """Map a policy over a transformed board back to the original board."""
+    result = np.empty_like(policy)
+    result[permutation(size, t)] = policy
+    return result
+
+
+def canonical_shapes(shapes: List[np.ndarray]) -> Tuple[int, List[np.ndarray]]:
+    """Pick one orientation of a set of winning shapes to stand for all of them.
+
+    Shapes are reduced to 0s and 1s, deduplicated and sorted, so the result
+    does not depend on their order either. Returns the transform t for which
+    [transform(shape, t) for shape in shapes] gives the canonical set, and the
+    canonical set itself. A board b of the original game corresponds to the
+    board transform(b, t) of the canonical one.
+    """
+    best, key = 0, None
+    for t in range(8):
+        candidate = sorted(
+            {
+                (shape.shape, shape.tobytes())
+                for shape in (
+                    np.ascontiguousarray(transform(np.asarray(x) != 0, t), np.int8)
+                    for x in shapes
+                )
+            }
+        )
+        if key is None or candidate < key:
+            best, key = t, candidate
+    return best, [np.frombuffer(data, np.int8).reshape(shape) for shape, data in key]
+
+
+def shapes_key(size: int, shapes: List[np.ndarray]) -> str:
+    """Name a game by a hash of its board size and canonical shapes."""
+    digest = hashlib.sha256(str(size).encode())
+    for shape in canonical_shapes(shapes)[1]:
+        digest.update(str(shape.shape).encode())
+        digest.update(shape.tobytes())
+    return digest.hexdigest()
@@ -1,62 +1,281 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 import copy
-from typing import List, Tuple, Dict
+import json
+import multiprocessing
+import os
+import shutil
+from typing import Callable, List, Optional, Tuple, Dict
 
 import numpy as np
 
 from libra.core.mcts import MCTS
 from libra.core.neuralnetwork import NeuralNet
+from libra.core.replay import ReplayBuffer
 from libra.core.state import State
 from libra.core import utils
 
+Example = Tuple[np.ndarray, np.ndarray, np.ndarray]
 
-def train(nnet: NeuralNet, start_state: State, args: Dict) -> NeuralNet:
-    examples = []
 
-    class RandomPlayer:
-        def predict_moves(self, state: State):
-            pis = state.moves().astype(float)
-            return pis / np.sum(pis)
-
-    for i in range(args["iters"]):
-        utils.info(f"Iteration {i + 1}/{args['iters']}")
-
-        utils.info("Genrating examples...")
-        for j in range(args["episodes"]):
-            examples += generate_examples(MCTS(nnet, args["simulations"]), start_state)
-            utils.info(f"Completed {j + 1}/{args['episodes']} sample games.")
-
-        utils.info(f"Training on {len(examples)} examples.")
-        newnet = copy.deepcopy(nnet)
-        newnet.train(examples)
-
-        utils.info("Testing against previous model.")
-        win_rate = test(
-            MCTS(newnet, args["simulations"]),
-            MCTS(nnet, args["simulations"]),
-            start_state,
-            args["matches"],
-        )
-
-        if win_rate >= args["threshold"]:
-            utils.info(f"Accepting new model (win-rate {win_rate})")
-            nnet = newnet
-        else:
-            utils.info(f"Rejecting new model (win-rate {win_rate})")
-
-        utils.info("Testing new model against a random player.")
-        random_rate = test(
-            MCTS(nnet, args["simulations"]),
-            RandomPlayer(),
-            start_state,
-            args["matches"],
-        )
-        utils.info(f"Current win-rate against random player: {random_rate}.\n")
+class RandomPlayer:
+    def predict_moves(self, state: State):
+        pis = state.moves().astype(float)
+        return pis / np.sum(pis)
+
+
+def train(
+    nnet: NeuralNet,
+    start_state: State,
+    args: Dict,
+    progress: Optional[Callable[[int, int], None]] = None,
+    resume: bool = False,
+) -> NeuralNet:
+    """Train nnet through self-play, calling progress(done, iters) each iteration.
+
+    If args["checkpoint"] names a directory, the examples are kept there and
+    the network is saved after every iteration. With resume set, training
+    continues from the last checkpoint, up to args["iters"] iterations in all.
+    If the first iteration was never finished, there is no checkpoint, and
+    training starts again from nnet with whatever examples were stored.
+    """
+    directory = args["checkpoint"]
+    if resume and directory is None:
+        raise ValueError("Resuming needs a checkpoint directory.")
+    first = 0
+    checkpoint = directory is not None and os.path.exists(
+        os.path.join(directory, "checkpoint.json")
+    )
+    if resume and checkpoint:
+        first, nnet = load_checkpoint(directory)
+        utils.info("Resuming after iteration %d.", first)
+    elif resume:
+        utils.info("No checkpoint in %s, resuming from the start.", directory)
+    elif checkpoint:
+        # Starting over, so an old checkpoint must not be resumed with the
+        # new examples.
+        os.remove(os.path.join(directory, "checkpoint.json"))
+    buffer = ReplayBuffer(
+        args["replay_capacity"],
+        start_state.size,
+        start_state.rules.symmetries,
+        args["replay_half_life"],
+        directory,
+        resume and os.path.exists(os.path.join(directory, "buffer.json")),
+    )
+
+    # One pool of workers serves every iteration; each task carries the
+    # weights it needs, which workers only rebuild when they change.
+    parallel = args["workers"] > 1
+    with worker_pool(start_state, args) if parallel else nullcontext() as pool:
+        for i in range(first, args["iters"]):
+            utils.info("Iteration %d/%d", i + 1, args["iters"])
+
+            utils.info("Genrating examples...")
+            with utils.timer("train_self_play_seconds"):
+                if parallel:
+                    buffer.extend(parallel_self_play(pool, nnet, args))
+                else:
+                    buffer.extend(self_play(nnet, start_state, args, args["episodes"]))
+
+            utils.info("Training on %d examples.", len(buffer))
+            with utils.timer("train_fit_seconds"):
+                newnet = copy.deepcopy(nnet)
+                newnet.train(buffer)
+
+            utils.info("Testing against previous model.")
+            with utils.timer("train_arena_seconds"):
+                if parallel:
+                    win_rate = parallel_test(pool, newnet, nnet, args)
+                else:
+                    win_rate = test(
+                        MCTS.from_args(newnet, args),
+                        MCTS.from_args(nnet, args),
+                        start_state,
+                        args["matches"],
+                    )
+
+            if win_rate >= args["threshold"]:
+                utils.info("Accepting new model (win-rate %s)", win_rate)
+                nnet = newnet
+            else:
+                utils.info("Rejecting new model (win-rate %s)", win_rate)
+
+            utils.info("Testing new model against a random player.")
+            with utils.timer("train_arena_seconds"):
+                if parallel:
+                    random_rate = parallel_test(pool, nnet, None, args)
+                else:
+                    random_rate = test(
+                        MCTS.from_args(nnet, args),
+                        RandomPlayer(),
+                        start_state,
+                        args["matches"],
+                    )
+            utils.info("Current win-rate against random player: %s.\n", random_rate)
+            if directory is not None:
+                save_checkpoint(directory, i + 1, nnet)
+            if progress is not None:
+                progress(i + 1, args["iters"])
     return nnet
 
 
-def generate_examples(
-    mcts: MCTS, start: State
-) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+def save_checkpoint(directory: str, iteration: int, nnet: NeuralNet):
+    """Save nnet as the result of iteration, replacing the previous checkpoint.
+
+    The new model is written beside the old one before checkpoint.json is
+    switched to it, so an interrupted save leaves the previous checkpoint.
+    """
+    filename = os.path.join(directory, "checkpoint.json")
+    previous = None
+    if os.path.exists(filename):
+        with open(filename) as f:
+            previous = json.load(f)["model"]
+    model = f"model-{iteration}"
+    nnet.save(os.path.join(directory, model))
+    with open(filename + ".tmp", "w") as f:
+        json.dump({"iteration": iteration, "model": model}, f)
+    os.replace(filename + ".tmp", filename)
+    if previous is not None and previous != model:
+        shutil.rmtree(os.path.join(directory, previous), ignore_errors=True)
+
+
+def load_checkpoint(directory: str) -> Tuple[int, NeuralNet]:
+    """Load the last iteration number and network saved in directory."""
+    with open(os.path.join(directory, "checkpoint.json")) as f:
+        checkpoint = json.load(f)
+    nnet = NeuralNet.from_file(os.path.join(directory, checkpoint["model"]))
+    return checkpoint["iteration"], nnet
+
+
+def self_play(
+    nnet: NeuralNet, start: State, args: Dict, episodes: int
+) -> List[Example]:
+    examples = []
+    if args["lockstep"] > 1:
+        for j in range(0, episodes, args["lockstep"]):
+            games = min(args["lockstep"], episodes - j)
+            examples += generate_examples_lockstep(nnet, start, args, games)
+            utils.info("Completed %d/%d sample games.", j + games, episodes)
+    else:
+        for j in range(episodes):
+            examples += generate_examples(MCTS.from_args(nnet, args), start)
+            utils.info("Completed %d/%d sample games.", j + 1, episodes)
+    return examples
+
+
+def parallel_self_play(
+    pool: ProcessPoolExecutor, nnet: NeuralNet, args: Dict
+) -> List[Example]:
+    """Split the self-play episodes between the processes of pool."""
+    examples = []
+    shares = split(args["episodes"], args["workers"])
+    models = [send(nnet)]
+    for packed in pool.map(worker_self_play, shares, [models] * len(shares)):
+        examples += unpack_examples(*packed)
+    return examples
+
+
+def parallel_test(
+    pool: ProcessPoolExecutor,
+    player1: NeuralNet,
+    player2: Optional[NeuralNet],
+    args: Dict,
+) -> float:
+    """Split the arena matches between the processes of pool.
+
+    If player2 is None, player1 is tested against a random player.
+    """
+    nnets = [player1] if player2 is None else [player1, player2]
+    shares = split(args["matches"], args["workers"])
+    models = [send(nnet) for nnet in nnets]
+    scores = pool.map(worker_test, shares, [models] * len(shares))
+    return sum(scores) / args["matches"]
+
+
+def split(total: int, workers: int) -> List[int]:
+    """Divide total jobs as evenly as possible between at most workers."""
+    shares = [total // workers + (w < total % workers) for w in range(workers)]
+    return [share for share in shares if share > 0]
+
+
+def worker_pool(start: State, args: Dict) -> ProcessPoolExecutor:
+    # Processes are spawned rather than forked so that they do not inherit the
+    # parent's TensorFlow runtime.
+    return ProcessPoolExecutor(
+        max_workers=args["workers"],
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(start, args),
+    )
+
+
+# A network as sent to workers: its version, model config and weights.
+Model = Tuple[int, str, List[np.ndarray]]
+
+_WORKER = {}
+
+
+def send(nnet: NeuralNet) -> Model:
+    # Networks are rebuilt from their own config, so workers match whatever
+    # architecture the parent trained or loaded.
+    return nnet.version, nnet.model.to_json(), nnet.model.get_weights()
+
+
+def init_worker(start: State, args: Dict):
+    _WORKER.update(start=start, args=args, nnets={})
+
+
+def worker_nnets(models: List[Model]) -> List[NeuralNet]:
+    """The networks of a task, rebuilt only if their version is new to this
+    worker. Networks no task needs any more are dropped."""
+    nnets = {}
+    for version, config, weights in models:
+        nnet = _WORKER["nnets"].get(version) or nnets.get(version)
+        nnets[version] = nnet or NeuralNet.from_weights(config, weights)
+    _WORKER["nnets"] = nnets
+    return [nnets[version] for version, _, _ in models]
+
+
+def worker_self_play(
+    episodes: int, models: List[Model]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    start, args, (nnet,) = _WORKER["start"], _WORKER["args"], worker_nnets(models)
+    return pack_examples(self_play(nnet, start, args, episodes))
+
+
+def worker_test(matches: int, models: List[Model]) -> float:
+    start, args, nnets = _WORKER["start"], _WORKER["args"], worker_nnets(models)
+    players = [MCTS.from_args(nnet, args) for nnet in nnets]
+    if len(players) == 1:
+        players.append(RandomPlayer())
+    return test(players[0], players[1], start, matches) * matches
+
+
+def pack_examples(
+    examples: List[Example],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Stack examples into compact arrays for sending between processes."""
+    if not examples:
+        return np.zeros((0, 0, 0), np.int8), np.zeros((0, 0)), np.zeros((0, 1))
+    boards, pis, vs = zip(*examples)
+    return (
+        np.asarray(boards, dtype=np.int8),
+        np.asarray(pis, dtype=np.float32),
+        np.asarray(vs, dtype=np.float32),
+    )
+
+
+def unpack_examples(
+    boards: np.ndarray, pis: np.ndarray, vs: np.ndarray
+) -> List[Example]:
+    return [
+        (board.astype(float), pi.astype(float), v.astype(float))
+        for board, pi, v in zip(boards, pis, vs)
+    ]
+
+
+def generate_examples(mcts: MCTS, start: State) -> List[Example]:
 
     examples = []
     state = start
@@ -64,50 +283,94 @@ def generate_examples(
     while True:
         res = state.result()
         if res is not None:
-            examples.reverse()
-            examples = [
-                (s, p, np.array([(-1) ** (i + 1) * float(res)]))
-                for (i, (s, p)) in enumerate(examples)
-            ]
-            return symmetries(examples)
+            return finish_examples(examples, res)
         move_pi = mcts.predict_moves(state)
         examples.append((state.board, move_pi))
         state = state.move(np.random.choice(range(len(move_pi)), p=move_pi))
+        mcts.reroot(state)
 
 
-def symmetries(
-    examples: List[Tuple[np.ndarray, np.ndarray, np.ndarray]]
-) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
-    size = examples[0][0].shape[0]
-
-    def transform(example, func):
-        board, pis, res = example
-        pis = pis.reshape((size, size))
-        board = func(board)
-        pis = func(pis).flatten()
-        return board, pis, res
+def generate_examples_lockstep(
+    nnet: NeuralNet, start: State, args: Dict, games: int
+) -> List[Example]:
+    """Play several self-play games at once, sharing network calls between them.
 
+    Every game keeps its own search tree, but on each step the leaves gathered
+    from all of the trees are evaluated in a single batch.
+    """
+    mcts = [MCTS.from_args(nnet, args) for _ in range(games)]
+    states = [start] * games
+    histories = [[] for _ in range(games)]
     results = []
-    for example in examples:
-        for _ in range(2):
-            for _ in range(4):
-                results.append(transform(example, np.rot90))
-            example = transform(example, np.fliplr)
-    return results
+
+    while True:
+        active = []
+        for g in range(games):
+            if states[g] is None:
+                continue
+            res = states[g].result()
+            if res is not None:
+                results += finish_examples(histories[g], res)
+                states[g] = None
+            else:
+                active.append(g)
+        if not active:
+            return results
+
+        remaining = {g: args["simulations"] for g in active}
+        while remaining:
+            requests = []
+            for g in list(remaining):
+                count = min(mcts[g].batch, remaining[g])
+                requests.append((g, mcts[g].gather(states[g], count)))
+                remaining[g] -= count
+                if remaining[g] == 0:
+                    del remaining[g]
+
+            leaves = [leaf for _, pending in requests for leaf in pending]
+            if not leaves:
+                continue
+            policies, values = mcts[0].evaluate(leaves)
+            offset = 0
+            for g, pending in requests:
+                end = offset + len(pending)
+                mcts[g].resolve(pending, policies[offset:end], values[offset:end])
+                offset = end
+
+        for g in active:
+            move_pi = mcts[g].distribution(states[g])
+            histories[g].append((states[g].board, move_pi))
+            move = np.random.choice(range(len(move_pi)), p=move_pi)
+            states[g] = states[g].move(move)
+            mcts[g].reroot(states[g])
+
+
+def finish_examples(
+    examples: List[Tuple[np.ndarray, np.ndarray]], res: float
+) -> List[Example]:
+    """Label a finished game's positions with its result.
+
+    Examples are not augmented here; ReplayBuffer turns them as it samples.
+    """
+    examples.reverse()
+    return [
+        (s, p, np.array([(-1) ** (i + 1) * float(res)]))
+        for (i, (s, p)) in enumerate(examples)
+    ]
 
 
 def test(player1: MCTS, player2, start: State, matches: int) -> float:
     score = 0.5 * matches
-    mcts = [player1, player2]
+    mcts = {1: player1, -1: player2}
     for i in range(matches):
         state = start
         current = 1
         while True:
-            utils.debug(f"Player: {current}. {state.__str__(current)}")
+            utils.debug("Player: %d. %s", current, utils.lazy(state.__str__, current))
             res = state.result()
             if res is not None:
                 res = current * res
-                utils.info(f"Match {i + 1}/{matches} result: {res}")
+                utils.info("Match %d/%d result: %s", i + 1, matches, res)
                 score += res * 0.5
                 break
             move_pi = mcts[current].predict_moves(state)
@@ -1,27 +1,60 @@
+import bisect
 import datetime
+import threading
+import time
+from typing import Dict, Optional, Sequence
 
 import sys
 
 LOGFILE = sys.stderr
 LOGLEVEL = 3
 
+# Metrics are kept per process as counters, which are running totals, and
+# histograms, which count observations per bucket and keep their sum. Recording
+# one takes a lock and a dictionary lookup, so they are cheap enough to leave
+# on; set METRICS_ENABLED to False to skip them.
+METRICS_ENABLED = True
+TIME_BUCKETS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100)
+SIZE_BUCKETS = tuple(2**i for i in range(21))
+BYTE_BUCKETS = tuple(4**i for i in range(5, 17))
+COUNTERS = {}
+HISTOGRAMS = {}
+_METRICS_LOCK = threading.Lock()
 
-def debug(message: str):
+
+# Messages are formatted with message % args, and only if they will be written,
+# so callers should pass their arguments rather than a pre-formatted string.
+
+
+class lazy:
+    """An argument for a log message which is only computed if it is written."""
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+
+def debug(message: str, *args):
     if LOGLEVEL >= 3:
-        log("[D] " + message)
+        log("[D] " + message, *args)
 
 
-def info(message: str):
+def info(message: str, *args):
     if LOGLEVEL >= 2:
-        log("[I] " + message)
+        log("[I] " + message, *args)
 
 
-def warn(message: str):
+def warn(message: str, *args):
     if LOGLEVEL >= 1:
-        log("[W] " + message)
+        log("[W] " + message, *args)
 
 
-def fail(message: str):
+def fail(message: str, *args):
+    if args:
+        message = message % args
     if LOGLEVEL >= 0:
         log("[F] " + message)
     raise Exception(message)
@@ -35,5 +68,114 @@ def clear():
         pass
 
 
-def log(message: str):
+def log(message: str, *args):
+    if args:
+        message = message % args
     LOGFILE.write(f"[{str(datetime.datetime.now())}] <core> " + message + "\n")
+
+
+def count(name: str, value: float = 1):
+    """Add value to a counter."""
+    if METRICS_ENABLED:
+        with _METRICS_LOCK:
+            COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def observe(name: str, value: float, buckets: Sequence[float] = SIZE_BUCKETS):
+    """Record value in a histogram, whose buckets are set by its first use."""
+    if METRICS_ENABLED:
+        with _METRICS_LOCK:
+            histogram = HISTOGRAMS.get(name)
+            if histogram is None:
+                histogram = HISTOGRAMS[name] = {
+                    "buckets": list(buckets),
+                    "counts": [0] * (len(buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+
+class timer:
+    """Record how long a with block takes, in seconds, in a histogram."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.begin, TIME_BUCKETS)
+
+
+def metrics() -> Dict:
+    """A copy of every metric, which can be dumped as JSON.
+
+    Each histogram's counts has one entry per bucket, counting observations up
+    to that bound and above the previous one, and a last entry for the rest.
+    """
+    with _METRICS_LOCK:
+        return {
+            "counters": dict(COUNTERS),
+            "histograms": {
+                name: dict(histogram, counts=list(histogram["counts"]))
+                for name, histogram in HISTOGRAMS.items()
+            },
+        }
+
+
+def merge(*snapshots: Dict) -> Dict:
+    """Add up metrics from several snapshots, as returned by metrics().
+
+    A histogram whose buckets differ from those it was first seen with is left
+    out, since its counts cannot be added.
+    """
+    merged = {"counters": {}, "histograms": {}}
+    for snapshot in snapshots:
+        for name, value in snapshot["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+        for name, histogram in snapshot["histograms"].items():
+            total = merged["histograms"].get(name)
+            if total is None:
+                merged["histograms"][name] = dict(
+                    histogram, counts=list(histogram["counts"])
+                )
+            elif total["buckets"] == histogram["buckets"]:
+                for i, count in enumerate(histogram["counts"]):
+                    total["counts"][i] += count
+                total["sum"] += histogram["sum"]
+                total["count"] += histogram["count"]
+            else:
+                warn("Histogram %s has different buckets; not merged.", name)
+    return merged
+
+
+def prometheus(prefix: str = "libra_", snapshot: Optional[Dict] = None) -> str:
+    """Format every metric, or those of snapshot, in the Prometheus text
+    exposition format."""
+    if snapshot is None:
+        snapshot = metrics()
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f"# TYPE {prefix}{name}_total counter")
+        lines.append(f"{prefix}{name}_total {value}")
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        lines.append(f"# TYPE {prefix}{name} histogram")
+        total = 0
+        bounds = histogram["buckets"] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["counts"]):
+            total += count
+            lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f"{prefix}{name}_sum {histogram['sum']}")
+        lines.append(f"{prefix}{name}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    with _METRICS_LOCK:
+        COUNTERS.clear()
+        HISTOGRAMS.clear()
@@ -0,0 +1,262 @@
+"""Background training jobs.
+
+Training a game takes minutes, so it runs in worker processes rather than in
+the web request. Each job trains one shared model and is a row of the
+TrainingJob table, so queued jobs outlive restarts of the web server. Workers
+claim queued jobs from the table, and send heartbeats while training; a
+running job whose heartbeats stop is claimed again by another worker. Progress
+is stored on the job and on every UserGame row waiting for it, and the /status
+route reads it from the job. A finished job also stores the metrics its worker
+recorded while training, which the /metrics route adds to its own.
+
+Run `python -m libra.jobs` to start a worker outside the web server, for
+example with TRAINING_WORKERS set to 0.
+"""
+
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+from libra import app, db
+from libra.models import TrainingJob, UserGame
+from libra.core.game import Game
+from libra.core import registry, utils
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_WORKERS = []
+
+
+def start():
+    """Start TRAINING_WORKERS worker processes, replacing any which died."""
+    global _WORKERS
+    _WORKERS = [process for process in _WORKERS if process.is_alive()]
+    # Spawned workers start without the web process's state and sessions.
+    context = multiprocessing.get_context("spawn")
+    while len(_WORKERS) < app.config["TRAINING_WORKERS"]:
+        process = context.Process(target=work, daemon=True)
+        process.start()
+        _WORKERS.append(process)
+
+
+def submit(model: str, size: int, shapes: List[np.ndarray]) -> str:
+    """Queue the training of model, unless it is trained or being trained.
+
+    Creating the job's row claims the training: the primary key lets only one
+    request create it, and every other request joins that job. A failed job is
+    queued again. shapes should be the canonical shapes of the model, see
+    symmetry.canonical_shapes. Returns the status of the job, DONE meaning the
+    model can be played at once.
+    """
+    # Models trained before jobs were stored only have finished UserGame rows.
+    trained = UserGame.query.filter_by(model=model, status=DONE).first() is not None
+    db.session.add(
+        TrainingJob(
+            model=model,
+            size=size,
+            shapes=json.dumps([np.asarray(shape).tolist() for shape in shapes]),
+            status=DONE if trained else QUEUED,
+            progress=1.0 if trained else 0.0,
+        )
+    )
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        TrainingJob.query.filter_by(model=model, status=FAILED).update(
+            {
+                "status": QUEUED,
+                "progress": 0.0,
+                "owner": None,
+                "heartbeat": datetime.now(),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+    job_status = TrainingJob.query.get(model).status
+    if job_status != DONE:
+        start()
+    return job_status
+
+
+def metrics() -> Dict:
+    """The metrics of every finished job, added up (see utils.merge)."""
+    rows = TrainingJob.query.filter(TrainingJob.metrics.isnot(None))
+    return utils.merge(*(json.loads(row.metrics) for row in rows))
+
+
+def status(user_game: UserGame) -> Tuple[str, float]:
+    """The training status and progress of user_game's model."""
+    job = TrainingJob.query.get(user_game.model) if user_game.model else None
+    if job is None:
+        # Games from before jobs were stored only have their own row.
+        return user_game.status, user_game.progress
+    return job.status, job.progress
+
+
+def work():
+    """Train claimed jobs one after another, forever."""
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    with app.app_context():
+        while True:
+            job = claim(owner)
+            if job is None:
+                time.sleep(app.config["JOB_POLL_SECONDS"])
+            else:
+                run(job.model, job.size, json.loads(job.shapes), owner)
+
+
+def claim(owner: str) -> Optional[TrainingJob]:
+    """Take the oldest queued job, or a running one whose worker has stopped."""
+    stale = datetime.now() - timedelta(seconds=app.config["JOB_TIMEOUT"])
+    candidates = (
+        TrainingJob.query.filter(
+            (TrainingJob.status == QUEUED)
+            | ((TrainingJob.status == RUNNING) & (TrainingJob.heartbeat < stale))
+        )
+        .order_by(TrainingJob.heartbeat)
+        .all()
+    )
+    for job in candidates:
+        model, previous, stopped = job.model, job.owner, job.status == RUNNING
+        # Only one worker can move the row on from the state read here.
+        claimed = TrainingJob.query.filter_by(
+            model=model, status=job.status, heartbeat=job.heartbeat
+        ).update(
+            {"status": RUNNING, "owner": owner, "heartbeat": datetime.now()},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            if stopped:
+                utils.warn("Reclaimed job %s from %s.", model, previous)
+            return TrainingJob.query.get(model)
+    db.session.commit()
+    return None
+
+
+def update(model: str, owner: str, **columns) -> bool:
+    """Record the progress of a job owner holds, on the job and its games.
+
+    Returns False if another worker has claimed the job since.
+    """
+    owned = TrainingJob.query.filter_by(model=model, owner=owner).update(
+        dict(columns, heartbeat=datetime.now()), synchronize_session=False
+    )
+    games = {
+        key: value for key, value in columns.items() if key in ("status", "progress")
+    }
+    if owned and games:
+        UserGame.query.filter(UserGame.model == model, UserGame.status != DONE).update(
+            games, synchronize_session=False
+        )
+    db.session.commit()
+    return bool(owned)
+
+
+class Reclaimed(Exception):
+    """Raised in a worker whose job another worker has claimed."""
+
+
+def heartbeat(model: str, owner: str, stop: threading.Event, lost: threading.Event):
+    """Tell other workers the job is alive until stop is set, setting lost if
+    another worker claims it."""
+    with app.app_context():
+        while not stop.wait(app.config["JOB_TIMEOUT"] / 4):
+            if not update(model, owner):
+                lost.set()
+                return
+
+
+def install(temporary: str, filename: str):
+    """Move a saved file or directory into place, replacing any older one."""
+    if os.path.isdir(filename):
+        # A directory cannot be replaced in one step, so move the old one
+        # aside first.
+        old = f"{filename}.old-{uuid.uuid4().hex[:8]}"
+        os.replace(filename, old)
+        os.replace(temporary, filename)
+        shutil.rmtree(old)
+    else:
+        os.replace(temporary, filename)
+
+
+def remove(filename: str):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename, ignore_errors=True)
+    elif os.path.exists(filename):
+        os.remove(filename)
+
+
+def run(model: str, size: int, shapes: List, owner: str):
+    """Train a model in a worker process, recording its progress and, once it
+    finishes, its metrics.
+
+    The model and its exports are saved under temporary names, and only moved
+    into place if this worker still holds the job, so that a worker which lost
+    its job cannot overwrite or mix with the files of the one which took it.
+    """
+    update(model, owner, status=RUNNING)
+    # Each job stores only the metrics recorded while training it.
+    utils.reset_metrics()
+    stop, lost = threading.Event(), threading.Event()
+    threading.Thread(
+        target=heartbeat, args=(model, owner, stop, lost), daemon=True
+    ).start()
+
+    def progress(done: int, total: int):
+        if not update(model, owner, progress=done / total):
+            raise Reclaimed(model)
+
+    temporary = f"models/{model}.{uuid.uuid4().hex[:8]}"
+    # Maps each temporary file to where it belongs.
+    files = {temporary: "models/" + model}
+    files.update(
+        (temporary + suffix, "models/" + model + suffix)
+        for suffix in registry.EXPORTS.values()
+    )
+    try:
+        game = Game(size, [np.array(shape) for shape in shapes], iters=1)
+        game.train(progress)
+        game.save_model(temporary)
+        for suffix in registry.EXPORTS.values():
+            game.export_model(temporary + suffix)
+        if lost.is_set() or not update(model, owner):
+            raise Reclaimed(model)
+        for saved, filename in files.items():
+            install(saved, filename)
+    except Reclaimed:
+        utils.warn("Job %s was claimed by another worker; dropping its results.", model)
+    except Exception as error:
+        utils.warn("Training model %s failed: %s", model, error)
+        update(model, owner, status=FAILED, metrics=json.dumps(utils.metrics()))
+    else:
+        update(
+            model,
+            owner,
+            status=DONE,
+            progress=1.0,
+            metrics=json.dumps(utils.metrics()),
+        )
+    finally:
+        stop.set()
+        for saved in files:
+            remove(saved)
+
+
+if __name__ == "__main__":
+    work()
@@ -26,6 +26,56 @@ class UserGame(db.Model):
     path = db.Column(db.String(50), unique=True, nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.now)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    # Databases from before training jobs and shared models need these three
+    # columns added, after which db.create_all() adds the new tables:
+    #   ALTER TABLE user_game ADD COLUMN status VARCHAR(10) NOT NULL DEFAULT 'done';
+    #   ALTER TABLE user_game ADD COLUMN progress FLOAT NOT NULL DEFAULT 1.0;
+    #   ALTER TABLE user_game ADD COLUMN model VARCHAR(64);
+    # The shared trained model, named by symmetry.shapes_key; games created
+    # before models were shared have their own model, named by path.
+    model = db.Column(db.String(64), nullable=True)
+    # The training job for the game's model, see jobs.py.
+    status = db.Column(
+        db.String(10), nullable=False, default="done", server_default="done"
+    )
+    progress = db.Column(db.Float, nullable=False, default=1.0, server_default="1.0")
 
     def __repr__(self):
         return f"Game('{self.path}', '{self.date_posted}', '{self.user_id}')"
+
+
+class TrainingJob(db.Model):
+    """The training of a shared model, see jobs.py."""
+
+    model = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    # The canonical shapes to train on, as JSON lists.
+    shapes = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="queued")
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    # The worker training the job, and when it last reported.
+    owner = db.Column(db.String(80), nullable=True)
+    heartbeat = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    # The metrics the worker recorded while training, as JSON from
+    # utils.metrics(), once the job has finished. Tables created before this
+    # column need it added:
+    #   ALTER TABLE training_job ADD COLUMN metrics TEXT;
+    metrics = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f"TrainingJob('{self.model}', '{self.status}')"
+
+
+class GameSession(db.Model):
+    """The position of the game a user is playing, see sessions.py."""
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    user_game_id = db.Column(db.Integer, db.ForeignKey("user_game.id"), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    # The board as int8 bytes, 1 for the computer and -1 for the user.
+    board = db.Column(db.LargeBinary, nullable=False)
+    player = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f"GameSession('{self.user_id}', '{self.user_game_id}')"
@@ -3,19 +3,34 @@ import pickle
 import random
 import string
 
-from flask import Flask, request, render_template, redirect, flash, url_for
+from flask import Flask, request, render_template, redirect, flash, url_for, jsonify
 from flask_login import login_user, current_user, logout_user, login_required
 import numpy as np
 
 from libra.models import User, UserGame
 from libra.forms import RegistrationForm, LoginForm
-from libra import app, db, bcrypt
-
-from libra.core import utils
-from libra.core.game import Game
-
-
-CURRENT_GAME = {}
+from libra import app, db, bcrypt, jobs, sessions
+
+from libra.core import cache, neuralnetwork, registry, remote, symmetry, utils
+
+registry.REGISTRY.capacity = app.config["MODEL_CACHE_BYTES"]
+cache.SHARED.capacity = app.config["EVALUATION_CACHE_SIZE"]
+neuralnetwork.configure(**app.config["TENSORFLOW"])
+remote.configure(**app.config["INFERENCE_SERVER"])
+
+
+@app.route("/metrics")
+def metrics():
+    """The metrics of this worker process and of the finished training jobs,
+    as JSON with ?format=json, or in the Prometheus text format."""
+    snapshot = utils.merge(utils.metrics(), jobs.metrics())
+    if request.args.get("format") == "json":
+        return jsonify(snapshot)
+    return (
+        utils.prometheus(snapshot=snapshot),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4"},
+    )
 
 
 @app.route("/favicon.ico")
@@ -102,35 +117,73 @@ def train():
         random.choice(string.ascii_letters + string.digits) for _ in range(10)
     )
 
-    user_game = UserGame(path=name + salts, user_id=current_user.get_id(), size=size)
+    model = symmetry.shapes_key(size, shapes)
+    job_status = jobs.submit(model, size, symmetry.canonical_shapes(shapes)[1])
+    user_game = UserGame(
+        path=name + salts,
+        model=model,
+        user_id=current_user.get_id(),
+        size=size,
+        status=job_status,
+        progress=1.0 if job_status == jobs.DONE else 0.0,
+    )
     db.session.add(user_game)
     db.session.commit()
 
-    game = Game(size, shapes, iters=1)
-    game.train()
-
-    game.save_model("models/" + name + salts)
     with open("shapes/" + name + salts, "wb") as shapefile:
         pickle.dump(shapes, shapefile)
 
-    CURRENT_GAME[current_user.get_id()] = game
-    return redirect(url_for("play"))
+    if job_status == jobs.DONE:
+        return redirect(url_for("replay", id=user_game.id))
+    return redirect(url_for("training", id=user_game.id))
+
+
+@app.route("/training")
+@login_required
+def training():
+    game_id = int(request.args.get("id", "1"))
+    user_game = UserGame.query.filter_by(
+        id=game_id, user_id=current_user.get_id()
+    ).first()
+    if not user_game:
+        flash("Game not found.", "warning")
+        return redirect(url_for("games"))
+    # Workers may not be running yet if the server restarted with jobs queued.
+    jobs.start()
+    job_status, progress = jobs.status(user_game)
+    return render_template(
+        "training.html", game=user_game, status=job_status, progress=progress
+    )
+
+
+@app.route("/status")
+@login_required
+def status():
+    game_id = int(request.args.get("id", "1"))
+    user_game = UserGame.query.filter_by(
+        id=game_id, user_id=current_user.get_id()
+    ).first()
+    if not user_game:
+        return jsonify(error="Game not found."), 404
+    job_status, progress = jobs.status(user_game)
+    return jsonify(status=job_status, progress=progress)
 
 
 @app.route("/play", methods=["GET", "POST"])
 @login_required
 def play():
-    uid = current_user.get_id()
-    if uid not in CURRENT_GAME:
-        redirect(url_for("home"))
-
-    g = CURRENT_GAME[uid]
+    uid = int(current_user.get_id())
+    g = sessions.get(uid)
+    if g is None:
+        flash("Choose a game to play first.", "info")
+        return redirect(url_for("games"))
 
     if request.method == "POST" and g.result() is None:
         g.move(int(request.form["choice"]))
 
     if g.current_player == 1 and g.result() is None:
-        g.move(g.predict())
+        g.move(g.predict(budget=app.config["MOVE_BUDGET"]))
+    sessions.save(uid, g)
 
     return render_template(
         "game.html", size=g.size, board=g.current_board(), winner=g.result()
@@ -154,8 +207,7 @@ def replay():
         flash("Game not found.", "warning")
         return redirect(url_for("games"))
     user_game = user_game[0]
-    with open("shapes/" + user_game.path, "rb") as f:
-        shapes = pickle.load(f)
-    game = Game(user_game.size, shapes, savefile="models/" + user_game.path)
-    CURRENT_GAME[uid] = game
+    if jobs.status(user_game)[0] != jobs.DONE:
+        return redirect(url_for("training", id=user_game.id))
+    sessions.start(int(uid), user_game)
     return redirect(url_for("play"))
@@ -0,0 +1,117 @@
+"""The games users are playing.
+
+Each user's position is stored in the GameSession table, so that any worker
+process can serve their next move. Workers also keep the Game objects they have
+recently served in a small cache, so that a user who keeps landing on the same
+worker keeps its search tree. A cached game is checked against the table on
+every request, and entries unused for SESSION_TTL seconds are dropped.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import pickle
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from libra import app, db
+from libra.models import GameSession, UserGame
+from libra.core.game import Game
+from libra.core import symmetry
+
+# Maps user ids to their game, the UserGame it plays and when it was last used.
+_GAMES = OrderedDict()
+_LOCK = threading.Lock()
+
+
+def load_game(user_game: UserGame) -> Game:
+    """Create a game playing user_game's trained model."""
+    with open("shapes/" + user_game.path, "rb") as f:
+        shapes = pickle.load(f)
+    if user_game.model:
+        return Game(
+            user_game.size,
+            shapes,
+            savefile="models/" + user_game.model,
+            backend=app.config["INFERENCE_BACKEND"],
+            orientation=symmetry.canonical_shapes(shapes)[0],
+        )
+    return Game(
+        user_game.size,
+        shapes,
+        savefile="models/" + user_game.path,
+        backend=app.config["INFERENCE_BACKEND"],
+    )
+
+
+def start(user_id: int, user_game: UserGame) -> Game:
+    """Start a new game of user_game for a user, replacing any other."""
+    game = load_game(user_game)
+    session = GameSession.query.get(user_id)
+    if session is None:
+        session = GameSession(user_id=user_id)
+        db.session.add(session)
+    session.user_game_id = user_game.id
+    save(user_id, game, session)
+    return game
+
+
+def get(user_id: int) -> Optional[Game]:
+    """Find the game a user is playing, at its stored position."""
+    session = GameSession.query.get(user_id)
+    if session is None:
+        return None
+    board = np.frombuffer(session.board, np.int8).reshape(session.size, session.size)
+
+    game = cached(user_id, session.user_game_id)
+    if game is None:
+        user_game = UserGame.query.get(session.user_game_id)
+        if user_game is None:
+            return None
+        game = load_game(user_game)
+    if game.current_player != session.player or not np.array_equal(
+        game.current_board(), board
+    ):
+        # Another worker has moved since this one last served the game.
+        game.set_position(board, session.player)
+    remember(user_id, session.user_game_id, game)
+    return game
+
+
+def save(user_id: int, game: Game, session: Optional[GameSession] = None):
+    """Store the position of a user's game."""
+    if session is None:
+        session = GameSession.query.get(user_id)
+    session.size = game.size
+    session.board = game.current_board().astype(np.int8).tobytes()
+    session.player = game.current_player
+    session.updated = datetime.now()
+    db.session.commit()
+    remember(user_id, session.user_game_id, game)
+
+
+def cached(user_id: int, user_game_id: int) -> Optional[Game]:
+    with _LOCK:
+        evict()
+        entry = _GAMES.get(user_id)
+        if entry is None or entry[1] != user_game_id:
+            return None
+        return entry[0]
+
+
+def remember(user_id: int, user_game_id: int, game: Game):
+    with _LOCK:
+        _GAMES[user_id] = (game, user_game_id, time.monotonic())
+        _GAMES.move_to_end(user_id)
+        evict()
+
+
+def evict():
+    """Drop expired games, then the least recently used beyond the limit."""
+    expired = time.monotonic() - app.config["SESSION_TTL"]
+    while _GAMES and next(iter(_GAMES.values()))[2] < expired:
+        _GAMES.popitem(last=False)
+    while len(_GAMES) > app.config["SESSION_CACHE_SIZE"]:
+        _GAMES.popitem(last=False)